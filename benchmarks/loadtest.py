@@ -0,0 +1,229 @@
+'''End-to-end load test using the fake SiriDB server.
+
+Measures inserts/s, queries/s, latency percentiles and CPU time per request
+for SiriDBClient, SiriDBConn and SiriDBConnection at different levels of
+concurrency and payload sizes.
+
+The fake server runs in a sub-process (unless --in-process is used) so the
+CPU time which is reported belongs to the connector only.
+
+Usage:
+
+    python benchmarks/loadtest.py --concurrency 1,16,128 --points 1,1000
+'''
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from siridb.connector import SiriDBClient  # noqa: E402
+from siridb.connector import SiriDBConn  # noqa: E402
+from siridb.connector import connect  # noqa: E402
+from siridb.connector.lib.fakeserver import FakeSiriDBServer  # noqa: E402
+
+USER, PASSWORD, DBNAME = 'iris', 'siri', 'dbtest'
+QUERY_SERIES = 'loadtest-query'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_subprocess_server(port, latency):
+    proc = subprocess.Popen(
+        [
+            sys.executable, '-m', 'siridb.connector.lib.fakeserver',
+            '--port', str(port),
+            '--latency', str(latency)
+        ],
+        cwd=os.path.join(os.path.dirname(__file__), '..'),
+        stdout=subprocess.PIPE)
+    proc.stdout.readline()  # wait until the server is listening
+    return proc
+
+
+def start_thread_server(port, latency):
+    started = threading.Event()
+
+    def run():
+        loop = asyncio.new_event_loop()
+        server = FakeSiriDBServer(users={USER: PASSWORD}, dbname=DBNAME)
+        server.latency = latency
+        loop.run_until_complete(server.start(port=port))
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+
+
+def payload(points, offset):
+    return {
+        'loadtest-{}'.format(offset % 100): [
+            [offset * points + i, 1.5] for i in range(points)]}
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def run_async(requests, concurrency, fun):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            await fun(i)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return latencies
+
+
+async def bench_client(port, requests, concurrency, points):
+    siri = SiriDBClient(
+        USER, PASSWORD, DBNAME, [('127.0.0.1', port)], keepalive=False)
+    await siri.connect()
+    await siri.insert({QUERY_SERIES: [[i, 1.5] for i in range(points)]})
+    try:
+        return await measure_async(siri, requests, concurrency, points)
+    finally:
+        siri.close()
+
+
+async def bench_conn(port, requests, concurrency, points):
+    siri = SiriDBConn(USER, PASSWORD, DBNAME, '127.0.0.1', port)
+    await siri.connect()
+    await siri.insert({QUERY_SERIES: [[i, 1.5] for i in range(points)]})
+    try:
+        return await measure_async(siri, requests, concurrency, points)
+    finally:
+        siri.close()
+
+
+async def measure_async(siri, requests, concurrency, points):
+    results = {}
+    for name, fun in (
+            ('insert', lambda i: siri.insert(payload(points, i))),
+            ('query', lambda i: siri.query(
+                'select * from "{}"'.format(QUERY_SERIES)))):
+        cpu, start = time.process_time(), time.perf_counter()
+        latencies = await run_async(requests, concurrency, fun)
+        results[name] = (
+            time.perf_counter() - start,
+            time.process_time() - cpu,
+            latencies)
+    return results
+
+
+def bench_connection(port, requests, concurrency, points):
+    siri = connect(USER, PASSWORD, DBNAME, port=port)
+    siri.insert({QUERY_SERIES: [[i, 1.5] for i in range(points)]})
+    query = 'select * from "{}"'.format(QUERY_SERIES)
+    results = {}
+    try:
+        for name, single, many, make in (
+                ('insert', siri.insert, siri.insert_many,
+                 lambda i: payload(points, i)),
+                ('query', siri.query, siri.query_many,
+                 lambda i: query)):
+            latencies = []
+            cpu, start = time.process_time(), time.perf_counter()
+            if concurrency == 1:
+                for i in range(requests):
+                    t0 = time.perf_counter()
+                    single(make(i))
+                    latencies.append(time.perf_counter() - t0)
+            else:
+                # latency is the time it takes to complete a batch
+                for offset in range(0, requests, concurrency):
+                    n = min(concurrency, requests - offset)
+                    t0 = time.perf_counter()
+                    for res in many([make(offset + i) for i in range(n)]):
+                        if isinstance(res, Exception):
+                            raise res
+                    latencies.extend([time.perf_counter() - t0] * n)
+            results[name] = (
+                time.perf_counter() - start,
+                time.process_time() - cpu,
+                latencies)
+    finally:
+        siri.close()
+    return results
+
+
+BENCHMARKS = {
+    'client': lambda *args: asyncio.run(bench_client(*args)),
+    'conn': lambda *args: asyncio.run(bench_conn(*args)),
+    'connection': bench_connection,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--clients', default='client,conn,connection',
+        help='comma separated list with: {}'.format(', '.join(BENCHMARKS)))
+    parser.add_argument(
+        '--concurrency', default='1,16,128',
+        help='comma separated list with concurrency levels')
+    parser.add_argument(
+        '--points', default='1,100,1000',
+        help='comma separated list with the number of points per insert')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument(
+        '--latency', type=float, default=0.0,
+        help='latency in seconds added by the fake server')
+    parser.add_argument(
+        '--in-process', action='store_true',
+        help='run the fake server in a thread instead of a sub-process')
+    args = parser.parse_args()
+
+    port = free_port()
+    proc = None
+    if args.in_process:
+        start_thread_server(port, args.latency)
+    else:
+        proc = start_subprocess_server(port, args.latency)
+
+    print('{:<11} {:>5} {:>6} {:<6} {:>10} {:>10} {:>10} {:>12}'.format(
+        'client', 'conc', 'points', 'type', 'req/s', 'p50 ms', 'p99 ms',
+        'cpu us/req'))
+    try:
+        for client in args.clients.split(','):
+            for concurrency in map(int, args.concurrency.split(',')):
+                for points in map(int, args.points.split(',')):
+                    results = BENCHMARKS[client](
+                        port, args.requests, concurrency, points)
+                    for name, (wall, cpu, latencies) in results.items():
+                        print(
+                            '{:<11} {:>5} {:>6} {:<6} {:>10.0f} {:>10.3f} '
+                            '{:>10.3f} {:>12.1f}'.format(
+                                client,
+                                concurrency,
+                                points,
+                                name,
+                                len(latencies) / wall,
+                                percentile(latencies, 50) * 1000,
+                                percentile(latencies, 99) * 1000,
+                                cpu / len(latencies) * 1e6), flush=True)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+'''Microbenchmarks for the protocol hot path.
+
+Measures _packdata, send_package, data_received, DataPackage and
+_on_package_received using synthetic byte streams: many tiny packages, a
+few huge ones, split and coalesced TCP reads and error packages.
+
+Reports ns/package, MB/s and the peak memory allocated during a run, and
+compares the result with a stored baseline to flag regressions.
+
+Usage:
+
+    python benchmarks/microbench.py --save baseline.json
+    python benchmarks/microbench.py --compare baseline.json --threshold 0.1
+'''
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import qpack  # noqa: E402
+from siridb.connector.lib import protomap  # noqa: E402
+from siridb.connector.lib.datapackage import DataPackage  # noqa: E402
+from siridb.connector.lib.protocol import _SiriDBProtocol  # noqa: E402
+from siridb.connector.lib.protocol import _packdata  # noqa: E402
+
+
+class _Transport:
+
+    def write(self, data):
+        pass
+
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 9000)
+
+
+class _Task:
+
+    def cancel(self):
+        pass
+
+
+def package(pid, tipe, data=None):
+    data = b'' if data is None else qpack.packb(data)
+    return DataPackage.struct_datapackage.pack(
+        len(data), pid, tipe, tipe ^ 255) + data
+
+
+def chunks(stream, size):
+    return [stream[i:i + size] for i in range(0, len(stream), size)]
+
+
+# futures created by a scenario, exceptions are retrieved after each run
+_futures = []
+
+
+def make_protocol(loop, pids):
+    protocol = _SiriDBProtocol('iris', 'siri', 'dbtest')
+    protocol.transport = _Transport()
+    protocol._connected = True
+    for pid in pids:
+        future = loop.create_future()
+        _futures.append(future)
+        protocol._requests[pid] = (future, _Task())
+    return protocol
+
+
+def retrieve_exceptions():
+    for future in _futures:
+        if future.done() and not future.cancelled():
+            future.exception()
+    _futures.clear()
+
+
+def bench_receive(reads, n, pids):
+    '''Feed reads to data_received() and resolve n pending requests.'''
+    nbytes = sum(map(len, reads))
+
+    def setup(loop):
+        protocol = make_protocol(loop, pids)
+
+        def run():
+            for data in reads:
+                protocol.data_received(data)
+        return run
+    return setup, n, nbytes
+
+
+def scenario_tiny(split):
+    n = 10000
+    stream = b''.join(
+        package(pid, protomap.CPROTO_RES_ACK) for pid in range(n))
+    reads = chunks(stream, split) if split else [stream]
+    return bench_receive(reads, n, range(n))
+
+
+def scenario_huge():
+    n = 4
+    result = {'series-{}'.format(i): [[ts, ts * 0.5] for ts in range(50000)]
+              for i in range(4)}
+    stream = b''.join(
+        package(pid, protomap.CPROTO_RES_QUERY, result) for pid in range(n))
+    return bench_receive(chunks(stream, 65536), n, range(n))
+
+
+def scenario_errors():
+    n = 5000
+    stream = b''.join(
+        package(pid, protomap.CPROTO_ERR_QUERY, {
+            'error_msg': 'Query error at position 7. Expecting *, all, ...'})
+        for pid in range(n))
+    return bench_receive([stream], n, range(n))
+
+
+def scenario_datapackage():
+    n = 10000
+    data = package(1, protomap.CPROTO_RES_QUERY, {'a': [[1, 1.5], [2, 2.5]]})
+    nbytes = len(data) * n
+
+    def setup(loop):
+        barray = bytearray(data * n)
+
+        def run():
+            while barray:
+                DataPackage(barray).extract_data_from(barray)
+        return run
+    return setup, n, nbytes
+
+
+def scenario_on_package_received():
+    n = 10000
+
+    def setup(loop):
+        protocol = make_protocol(loop, range(n))
+        packages = []
+        for pid in range(n):
+            pkg = DataPackage(package(pid, protomap.CPROTO_RES_INSERT))
+            pkg.data = {'success_msg': 'Successfully inserted 1 point(s).'}
+            packages.append(pkg)
+
+        def run():
+            for pkg in packages:
+                protocol._data_package = pkg
+                protocol._on_package_received()
+        return run
+    return setup, n, 0
+
+
+def scenario_packdata(tipe, data):
+    n = 10000
+    nbytes = len(_packdata(tipe, data)) * n
+
+    def setup(loop):
+        def run():
+            for _ in range(n):
+                _packdata(tipe, data)
+        return run
+    return setup, n, nbytes
+
+
+def scenario_send_package(data):
+    n = 10000
+    nbytes = (len(_packdata(protomap.CPROTO_REQ_INSERT, data)) +
+              DataPackage.struct_datapackage.size) * n
+
+    def setup(loop):
+        protocol = make_protocol(loop, ())
+
+        def run():
+            for _ in range(n):
+                protocol.send_package(protomap.CPROTO_REQ_INSERT, data)
+            for _future, task in protocol._requests.values():
+                task.cancel()
+        return run
+    return setup, n, nbytes
+
+
+SMALL_INSERT = {'series': [[1, 1.5]]}
+LARGE_INSERT = {'series-{}'.format(i): [[ts, 1.5] for ts in range(100)]
+                for i in range(10)}
+
+SCENARIOS = {
+    'packdata_query': lambda: scenario_packdata(
+        protomap.CPROTO_REQ_QUERY, ('select * from "series"', None)),
+    'packdata_insert_small': lambda: scenario_packdata(
+        protomap.CPROTO_REQ_INSERT, SMALL_INSERT),
+    'packdata_insert_large': lambda: scenario_packdata(
+        protomap.CPROTO_REQ_INSERT, LARGE_INSERT),
+    'send_package_small': lambda: scenario_send_package(SMALL_INSERT),
+    'send_package_large': lambda: scenario_send_package(LARGE_INSERT),
+    'datapackage': scenario_datapackage,
+    'on_package_received': scenario_on_package_received,
+    'receive_tiny_coalesced': lambda: scenario_tiny(None),
+    'receive_tiny_split': lambda: scenario_tiny(5),
+    'receive_tiny_mtu': lambda: scenario_tiny(1448),
+    'receive_huge': scenario_huge,
+    'receive_errors': scenario_errors,
+}
+
+
+async def measure(scenario, repeat):
+    loop = asyncio.get_running_loop()
+    setup, n, nbytes = scenario()
+    best = float('inf')
+    for _ in range(repeat):
+        run = setup(loop)
+        start = time.perf_counter_ns()
+        run()
+        best = min(best, time.perf_counter_ns() - start)
+        retrieve_exceptions()
+        await asyncio.sleep(0)  # let cancelled tasks finish
+
+    run = setup(loop)
+    tracemalloc.start()
+    run()
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    retrieve_exceptions()
+    await asyncio.sleep(0)
+
+    return {
+        'ns_per_package': best / n,
+        'mb_per_sec': nbytes / best * 1e3 if nbytes else None,
+        'peak_kib': peak / 1024,
+    }
+
+
+async def run_all(names, repeat):
+    return {name: await measure(SCENARIOS[name], repeat) for name in names}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--scenarios', default=','.join(SCENARIOS),
+        help='comma separated list with scenarios to run')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save', help='save the results as baseline')
+    parser.add_argument('--compare', help='compare with a saved baseline')
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='flag a regression when slower than the baseline by more '
+             'than this fraction (default: 0.1)')
+    args = parser.parse_args()
+
+    results = asyncio.run(run_all(args.scenarios.split(','), args.repeat))
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+
+    regressions = 0
+    print('{:<24} {:>12} {:>10} {:>10} {:>10}'.format(
+        'scenario', 'ns/package', 'MB/s', 'peak KiB', 'change'))
+    for name, result in results.items():
+        change = ''
+        if name in baseline:
+            ratio = result['ns_per_package'] / \
+                baseline[name]['ns_per_package'] - 1.0
+            change = '{:+.1%}'.format(ratio)
+            if ratio > args.threshold:
+                change += ' REGRESSION'
+                regressions += 1
+        print('{:<24} {:>12.1f} {:>10} {:>10.1f} {:>10}'.format(
+            name,
+            result['ns_per_package'],
+            '-' if result['mb_per_sec'] is None
+            else '{:.1f}'.format(result['mb_per_sec']),
+            result['peak_kib'],
+            change))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+'''Scaling benchmark for the multi-loop client.
+
+Measures inserts/s and queries/s for a MultiLoopClient with a different
+number of event loops, compared with a single SiriDBClient. Fake servers
+run in sub-processes, one per server, so the servers do not compete with
+the client for the GIL.
+
+Usage:
+
+    python benchmarks/multiloop.py --loops 1,2,4,8 --servers 4 --points 1000
+'''
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from siridb.connector import SiriDBClient  # noqa: E402
+from siridb.connector.lib.multiloop import MultiLoopClient  # noqa: E402
+from loadtest import USER, PASSWORD, DBNAME  # noqa: E402
+from loadtest import free_port, start_subprocess_server  # noqa: E402
+from loadtest import payload, percentile, run_async  # noqa: E402
+
+QUERY_SERIES = 'multiloop-query'
+
+
+async def setup(ports, points):
+    # each fake server has its own data, so the query series is inserted
+    # on every server
+    for port in ports:
+        siri = SiriDBClient(
+            USER, PASSWORD, DBNAME, [('127.0.0.1', port)], keepalive=False)
+        await siri.connect()
+        await siri.insert({QUERY_SERIES: [[i, 1.5] for i in range(points)]})
+        siri.close()
+
+
+async def measure(siri, requests, concurrency, points):
+    query = 'select * from "{}"'.format(QUERY_SERIES)
+    results = {}
+    for name, fun in (
+            ('insert', lambda i: siri.insert(payload(points, i))),
+            ('query', lambda i: siri.query(query))):
+        cpu, start = time.process_time(), time.perf_counter()
+        latencies = await run_async(requests, concurrency, fun)
+        results[name] = (
+            time.perf_counter() - start,
+            time.process_time() - cpu,
+            latencies)
+    return results
+
+
+async def bench(hostlist, loops, requests, concurrency, points):
+    if loops:
+        siri = MultiLoopClient(
+            USER, PASSWORD, DBNAME, hostlist, loops=loops, keepalive=False)
+    else:
+        siri = SiriDBClient(
+            USER, PASSWORD, DBNAME, hostlist, keepalive=False)
+    await siri.connect()
+    try:
+        return await measure(siri, requests, concurrency, points)
+    finally:
+        if loops:
+            await siri.close()
+        else:
+            siri.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--loops', default='1,2,4',
+        help='comma separated list with the number of loops, 0 uses a '
+             'single SiriDBClient on the main loop')
+    parser.add_argument(
+        '--servers', type=int, default=4,
+        help='number of fake server processes')
+    parser.add_argument(
+        '--connections', type=int, default=2,
+        help='number of connections per server')
+    parser.add_argument('--concurrency', type=int, default=128)
+    parser.add_argument('--points', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=4000)
+    args = parser.parse_args()
+
+    ports = [free_port() for _ in range(args.servers)]
+    procs = [start_subprocess_server(port, 0.0) for port in ports]
+    hostlist = [('127.0.0.1', port) for port in ports] * args.connections
+    asyncio.run(setup(ports, args.points))
+
+    print('cpu count: {}'.format(os.cpu_count()))
+    print('{:<7} {:<6} {:>10} {:>10} {:>10} {:>10} {:>12}'.format(
+        'loops', 'type', 'req/s', 'speedup', 'p50 ms', 'p99 ms',
+        'cpu us/req'))
+    base = {}
+    try:
+        for loops in map(int, ['0'] + args.loops.split(',')):
+            results = asyncio.run(bench(
+                hostlist, loops, args.requests, args.concurrency,
+                args.points))
+            for name, (wall, cpu, latencies) in results.items():
+                rate = len(latencies) / wall
+                base.setdefault(name, rate)
+                print(
+                    '{:<7} {:<6} {:>10.0f} {:>10.2f} {:>10.3f} {:>10.3f} '
+                    '{:>12.1f}'.format(
+                        loops or 'single',
+                        name,
+                        rate,
+                        rate / base[name],
+                        percentile(latencies, 50) * 1000,
+                        percentile(latencies, 99) * 1000,
+                        cpu / len(latencies) * 1e6), flush=True)
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -9,8 +9,7 @@ twine upload --repository pypitest dist/siridb-connector-X.X.X.tar.gz
 twine upload --repository pypi dist/siridb-connector-X.X.X.tar.gz
 """
 
-from distutils.core import setup
-import setuptools
+from setuptools import setup
 from siridb import __version__
 
 
@@ -54,5 +53,10 @@ setup(
         'Topic :: Database',
         'Topic :: Software Development'
     ],
-    install_requires=['qpack']
+    install_requires=['qpack'],
+    entry_points={
+        'console_scripts': [
+            'siridb-import = siridb.connector.lib.importer:main',
+        ],
+    },
 )
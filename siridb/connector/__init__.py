@@ -1,25 +1,37 @@
 import asyncio
 from .lib.protocol import _SiriDBProtocol
 from .lib.protocol import _SiriDBInfoProtocol
+from .lib.protocol import encode_insert
 from .lib.connection import SiriDBConnection
 from .lib.defaults import DEFAULT_CLIENT_PORT
 from .lib.client import SiriDBClient, SiriDBAsyncConnection, SiriDBConn
+from .lib.aggregate import InsertAggregator
+from .lib.metrics import Metrics
+from .lib.lazy import LazyResult
 from .lib.constants import SECOND
 from .lib.constants import MICROSECOND
 from .lib.constants import MILLISECOND
 from .lib.constants import NANOSECOND
+from .lib.constants import PRIORITY_INTERACTIVE
+from .lib.constants import PRIORITY_BULK
 
 __all__ = [
     'async_connect',
     'async_server_info',
     'connect',
+    'encode_insert',
+    'InsertAggregator',
+    'LazyResult',
+    'Metrics',
     'SiriDBClient',
     'SiriDBProtocol',
     'SiriDBConn',
     'SECOND',
     'MICROSECOND',
     'MILLISECOND',
-    'NANOSECOND'
+    'NANOSECOND',
+    'PRIORITY_INTERACTIVE',
+    'PRIORITY_BULK'
 ]
 
 
@@ -42,7 +54,12 @@ def connect(username,
             port=DEFAULT_CLIENT_PORT,
             loop=None,
             timeout=10,
-            protocol=SiriDBProtocol):
+            protocol=SiriDBProtocol,
+            sockopts=None,
+            write_buffer_limits=None,
+            metrics=None,
+            recorder=None,
+            response_limits=None):
     """WARNING: Creates a new asyncio event loop if none is given."""
     return SiriDBConnection(
         username,
@@ -52,7 +69,12 @@ def connect(username,
         port=port,
         loop=loop,
         timeout=timeout,
-        protocol=protocol)
+        protocol=protocol,
+        sockopts=sockopts,
+        write_buffer_limits=write_buffer_limits,
+        metrics=metrics,
+        recorder=recorder,
+        response_limits=response_limits)
 
 
 async def async_connect(username,
@@ -63,7 +85,12 @@ async def async_connect(username,
                         loop=None,
                         timeout=10,
                         keepalive=False,
-                        protocol=SiriDBProtocol):
+                        protocol=SiriDBProtocol,
+                        sockopts=None,
+                        write_buffer_limits=None,
+                        metrics=None,
+                        recorder=None,
+                        response_limits=None):
 
     connection = SiriDBAsyncConnection()
     await connection.connect(
@@ -75,7 +102,12 @@ async def async_connect(username,
         loop=loop,
         timeout=timeout,
         keepalive=keepalive,
-        protocol=protocol)
+        protocol=protocol,
+        sockopts=sockopts,
+        write_buffer_limits=write_buffer_limits,
+        metrics=metrics,
+        recorder=recorder,
+        response_limits=response_limits)
 
     return connection
 
@@ -0,0 +1,201 @@
+'''Insert Aggregator.
+
+Aggregates points on the client before they are inserted into SiriDB.
+
+:copyright: 2022, Jeroen van der Heijden (Cesbit.com)
+'''
+import array
+import asyncio
+from .logging import logger as logging
+
+
+# insert() flushes completed buckets when at least x points are pending
+DEFAULT_MAX_PENDING = 100000
+
+
+def _mean(value, count):
+    return value / count
+
+
+def _value(value, count):
+    return value
+
+
+# functions: (update, finalize, force float values)
+_FUNCTIONS = {
+    'mean': (lambda value, new: value + new, _mean, True),
+    'sum': (lambda value, new: value + new, _value, False),
+    'min': (min, _value, False),
+    'max': (max, _value, False),
+    'last': (lambda value, new: new, _value, False),
+}
+
+
+class _Series:
+
+    __slots__ = ('bucket', 'count', 'value', 'timestamps', 'values')
+
+    def __init__(self):
+        self.bucket = None
+        self.count = 0
+        self.value = None
+        self.timestamps = array.array('q')
+        self.values = None
+
+
+class InsertAggregator:
+    '''Aggregate points per series before inserting them into SiriDB.
+
+    Points are grouped per series in buckets of `interval` (using the time
+    precision of the database) and are aggregated using `func`, which is
+    either mean, min, max, last or sum. Like SiriDB aggregations, the
+    timestamp of a bucket is the end of the bucket.
+
+    A bucket is completed when a point for a newer bucket is received, or
+    when flush() is called. A point for a completed (or older) bucket is
+    dropped since it cannot be merged with a bucket which is already
+    inserted; the number of dropped points is counted in `dropped`.
+
+    Completed buckets are inserted using the insert() method of `target`,
+    which can be a SiriDBClient, SiriDBConn or SiriDBAsyncConnection. This
+    happens every `flush_interval` seconds (when given), when at least
+    `max_pending` points are pending, or when flush() is called. When an
+    insert fails, the aggregated points are kept and are inserted with the
+    next flush.
+    '''
+
+    def __init__(self,
+                 target,
+                 interval,
+                 func='mean',
+                 flush_interval=None,
+                 max_pending=DEFAULT_MAX_PENDING,
+                 timeout=300,
+                 loop=None):
+        assert interval > 0, 'interval should be a positive integer'
+        assert func in _FUNCTIONS, \
+            'func should be one of: {}'.format(', '.join(_FUNCTIONS))
+        self._target = target
+        self._interval = interval
+        self._update, self._finalize, self._is_float = _FUNCTIONS[func]
+        self._max_pending = max_pending
+        self._timeout = timeout
+        self._series = {}
+        self._pending = 0
+        self._flush_task = None
+        self.dropped = 0
+        if flush_interval is not None:
+            loop = loop or asyncio.get_running_loop()
+            self._flush_task = loop.create_task(
+                self._flush_loop(flush_interval))
+
+    async def insert(self, data):
+        '''Aggregate data using the same format as a normal insert.
+
+        Returns the result of the insert when completed buckets are flushed,
+        otherwise None.
+        '''
+        interval = self._interval
+        for name, points in data.items():
+            series = self._series.get(name)
+            if series is None:
+                series = self._series[name] = _Series()
+            for ts, value in points:
+                bucket = -(-ts // interval) * interval
+                if bucket == series.bucket and series.count:
+                    series.count += 1
+                    series.value = self._update(series.value, value)
+                elif series.bucket is None or bucket > series.bucket:
+                    if series.count:
+                        self._complete(series)
+                    series.bucket = bucket
+                    series.count = 1
+                    series.value = value
+                else:
+                    self.dropped += 1
+                    logging.debug(
+                        'Dropped a late point for series {!r} at {}'
+                        .format(name, ts))
+
+        if self._pending >= self._max_pending:
+            return await self.flush(complete_only=True)
+
+    async def flush(self, complete_only=False):
+        '''Insert aggregated points.
+
+        Buckets which are not yet completed are included as well, unless
+        `complete_only` is True. Returns the result of the insert or None
+        when there was nothing to insert.
+        '''
+        data, detached = {}, {}
+        for name, series in self._series.items():
+            if not complete_only and series.count:
+                self._complete(series)
+            if series.timestamps:
+                data[name] = [
+                    [ts, value]
+                    for ts, value in zip(series.timestamps, series.values)]
+                detached[name] = (series.timestamps, series.values)
+                series.timestamps = array.array('q')
+                series.values = None
+
+        self._pending = 0
+
+        if data:
+            try:
+                return await self._target.insert(data, timeout=self._timeout)
+            except BaseException:
+                self._restore(detached)
+                raise
+
+    def close(self):
+        '''Stop flushing automatically. Pending points are not inserted,
+        use flush() for this.'''
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+    def _complete(self, series):
+        self._append(
+            series,
+            series.bucket,
+            self._finalize(series.value, series.count))
+        series.count = 0
+        series.value = None
+
+    def _restore(self, detached):
+        '''Put points back in front of points which are added since.'''
+        for name, (timestamps, values) in detached.items():
+            series = self._series.get(name)
+            if series is None:
+                series = self._series[name] = _Series()
+            self._pending += len(timestamps)
+            if series.timestamps:
+                timestamps.extend(series.timestamps)
+                if values.typecode != series.values.typecode:
+                    values = array.array('d', values)
+                    values.extend(array.array('d', series.values))
+                else:
+                    values.extend(series.values)
+            series.timestamps, series.values = timestamps, values
+
+    def _append(self, series, ts, value):
+        if series.values is None:
+            series.values = array.array(
+                'd' if self._is_float or isinstance(value, float) else 'q')
+        elif series.values.typecode == 'q' and isinstance(value, float):
+            series.values = array.array('d', series.values)
+        series.timestamps.append(ts)
+        series.values.append(value)
+        self._pending += 1
+
+    async def _flush_loop(self, flush_interval):
+        while True:
+            await asyncio.sleep(flush_interval)
+            try:
+                await self.flush(complete_only=True)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logging.error('Failed to insert aggregated points: {}'
+                              .format(str(e) or type(e).__name__))
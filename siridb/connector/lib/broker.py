@@ -0,0 +1,423 @@
+'''Connection broker for multi-process deployments.
+
+A broker is a single local process which owns the connections to SiriDB.
+Worker processes connect to the broker using a Unix socket and speak the
+SiriDB client protocol, so insert data which is encoded by a worker is
+forwarded unchanged. Optionally, inserts from multiple workers are batched
+into a single insert; the encoded maps are joined without decoding them, so
+a series may be in a batched insert more than once.
+
+Authentication is not forwarded; access to the broker is controlled by the
+permissions of the socket file.
+
+Usage as script:
+
+    python -m siridb.connector.lib.broker /tmp/siridb.sock \\
+        --servers server1:9000,server2:9000 --batch-interval 0.05
+
+:copyright: 2022, Jeroen van der Heijden (Cesbit.com)
+'''
+import argparse
+import asyncio
+import os
+import qpack
+from . import protomap
+from .datapackage import DataPackage
+from .protocol import _SiriDBProtocol
+from .protocol import encode_insert
+from .connection import _is_encoded
+from .exceptions import QueryError
+from .exceptions import InsertError
+from .exceptions import ServerError
+from .exceptions import PoolError
+from .exceptions import PackageError
+from .exceptions import UserAuthError
+from .logging import logger as logging
+
+
+# a batch of inserts is sent when it reaches x bytes
+DEFAULT_BATCH_MAX_BYTES = 1024 * 1024
+
+# qpack map types, a map with x items (up to 5) uses _QP_MAP0 + x
+_QP_MAP0 = 0xf3
+_QP_MAP5 = 0xf8
+_QP_OPEN_MAP = 0xfd
+_QP_CLOSE_MAP = 0xff
+
+# exception, response type
+_ERRORS = (
+    (QueryError, protomap.CPROTO_ERR_QUERY),
+    (InsertError, protomap.CPROTO_ERR_INSERT),
+    (ServerError, protomap.CPROTO_ERR_SERVER),
+    (PoolError, protomap.CPROTO_ERR_POOL),
+    (UserAuthError, protomap.CPROTO_ERR_USER_ACCESS),
+)
+
+# other exceptions are sent as error message with the class name, which is
+# used by BrokerClient to raise the same exception
+_ERROR_CLASSES = {
+    exc.__name__: exc for exc in (
+        TimeoutError,
+        ConnectionError,
+        OverflowError,
+        PackageError,
+        ValueError,
+        TypeError,
+    )
+}
+
+
+def _map_body(data):
+    '''Returns the encoded keys and values of a map without the map type,
+    or None for an open map without a close marker.
+
+    Raises a ValueError when the data is not an encoded map.
+    '''
+    tp = data[0] if data else None
+    if tp is not None and _QP_MAP0 <= tp <= _QP_MAP5:
+        return memoryview(data)[1:]
+    if tp == _QP_OPEN_MAP:
+        return memoryview(data)[1:-1] if data[-1] == _QP_CLOSE_MAP else None
+    raise ValueError('Insert data should be a map with series and points')
+
+
+class _BrokerProtocol(asyncio.Protocol):
+
+    def __init__(self, broker):
+        self._broker = broker
+        self._buffered_data = bytearray()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self._buffered_data.extend(data)
+        size = DataPackage.struct_datapackage.size
+        while len(self._buffered_data) >= size:
+            length, pid, tipe, checkbit = \
+                DataPackage.struct_datapackage.unpack_from(
+                    self._buffered_data, offset=0)
+            if tipe ^ 255 != checkbit:
+                logging.error('Broker received an invalid checkbit')
+                self.transport.abort()
+                return
+            if len(self._buffered_data) < size + length:
+                break
+            data = bytes(self._buffered_data[size:size + length])
+            del self._buffered_data[:size + length]
+            asyncio.ensure_future(self._handle(pid, tipe, data))
+
+    async def _handle(self, pid, tipe, data):
+        broker = self._broker
+        try:
+            if tipe == protomap.CPROTO_REQ_AUTH:
+                response = protomap.CPROTO_RES_AUTH_SUCCESS, None
+            elif tipe == protomap.CPROTO_REQ_PING:
+                response = protomap.CPROTO_RES_ACK, None
+            elif tipe == protomap.CPROTO_REQ_INSERT:
+                response = protomap.CPROTO_RES_INSERT, \
+                    await broker._insert(data)
+            elif tipe == protomap.CPROTO_REQ_QUERY:
+                query, time_precision = qpack.unpackb(data, decode='utf-8')
+                response = protomap.CPROTO_RES_QUERY, \
+                    await broker._client.query(
+                        query,
+                        time_precision=time_precision,
+                        timeout=broker._timeout)
+            else:
+                response = protomap.CPROTO_ERR_MSG, {
+                    'error_msg': 'Broker does not support package type: {}'
+                                 .format(protomap.TEXT_REQ_MAP.get(
+                                     tipe, tipe))}
+        except Exception as e:
+            tp = next(
+                (tp for exc, tp in _ERRORS if isinstance(e, exc)),
+                protomap.CPROTO_ERR_MSG)
+            msg = str(e) or type(e).__name__
+            if tp == protomap.CPROTO_ERR_MSG:
+                msg = '{}: {}'.format(type(e).__name__, msg)
+            response = tp, {'error_msg': msg}
+        self.send(pid, *response)
+
+    def send(self, pid, tipe, data=None):
+        if self.transport is None or self.transport.is_closing():
+            return
+        data = b'' if protomap.MAP_RES_DTYPE.get(tipe) == protomap.DTYPE_NONE \
+            else qpack.packb(data)
+        self.transport.write(DataPackage.struct_datapackage.pack(
+            len(data),
+            pid,
+            tipe,
+            tipe ^ 255) + data)
+
+
+class SiriDBBroker:
+    '''Share the connections of a SiriDBClient with local processes.
+
+    Arguments:
+        client: A SiriDBClient which is used to forward requests.
+        path: File name of the Unix socket.
+
+    Keyword arguments:
+        batch_interval: When set, inserts are collected for at most x
+                        seconds and are sent as a single insert. Each
+                        worker receives the response of the batch.
+        batch_max_bytes: A batch is sent right away when it reaches this
+                         size.
+        timeout: Timeout used for forwarded requests.
+
+    Batched inserts are not decoded; the encoded maps of the workers are
+    joined into a single map. Inserts must therefore be encoded maps, an
+    insert which is not a map is answered with an error. When a batch fails
+    with an InsertError, the insert of each worker is sent on its own, so
+    only a worker with invalid data receives the error.
+    '''
+
+    def __init__(self,
+                 client,
+                 path,
+                 batch_interval=None,
+                 batch_max_bytes=DEFAULT_BATCH_MAX_BYTES,
+                 timeout=300):
+        self._client = client
+        self._path = path
+        self._batch_interval = batch_interval
+        self._batch_max_bytes = batch_max_bytes
+        self._timeout = timeout
+        self._batch = []
+        self._batch_futures = []
+        self._batch_size = 0
+        self._batch_handle = None
+        self._batch_tasks = set()
+        self._server = None
+
+    async def start(self):
+        '''Start listening on the Unix socket.'''
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_unix_server(
+            lambda: _BrokerProtocol(self),
+            path=self._path)
+
+    def close(self):
+        '''Stop listening. Batched inserts are still sent, use wait_closed()
+        to wait until they are done.'''
+        if self._batch_handle is not None:
+            self._batch_handle.cancel()
+            self._flush()
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            try:
+                os.unlink(self._path)
+            except FileNotFoundError:
+                pass
+
+    async def wait_closed(self):
+        '''Wait until all batched inserts are done.'''
+        while self._batch_tasks:
+            await asyncio.wait(set(self._batch_tasks))
+
+    async def _insert(self, data):
+        if self._batch_interval is None:
+            return await self._client.insert(data, timeout=self._timeout)
+
+        body = _map_body(data)
+        if body is None:
+            # an open map without a close marker cannot be joined
+            return await self._client.insert(data, timeout=self._timeout)
+
+        self._batch.append(body)
+        future = asyncio.get_running_loop().create_future()
+        self._batch_futures.append((future, data))
+        self._batch_size += len(data)
+        if self._batch_size >= self._batch_max_bytes:
+            if self._batch_handle is not None:
+                self._batch_handle.cancel()
+            self._flush()
+        elif self._batch_handle is None:
+            self._batch_handle = asyncio.get_running_loop().call_later(
+                self._batch_interval, self._flush)
+        return await future
+
+    def _flush(self):
+        batch, futures = self._batch, self._batch_futures
+        self._batch, self._batch_futures, self._batch_size = [], [], 0
+        self._batch_handle = None
+        if futures:
+            task = asyncio.ensure_future(self._send_batch(batch, futures))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _send_batch(self, batch, futures):
+        data = futures[0][1] if len(futures) == 1 else b''.join((
+            bytes((_QP_OPEN_MAP,)), *batch, bytes((_QP_CLOSE_MAP,))))
+        try:
+            result = await self._client.insert(data, timeout=self._timeout)
+        except (InsertError, OverflowError) as e:
+            # the error is caused by the data of at least one worker
+            if len(futures) == 1:
+                self._set_result(futures[0][0], exc=e)
+                return
+            logging.debug('Batched insert failed with error {!r}, sending '
+                          'each insert on its own...'.format(e))
+            await asyncio.gather(*(
+                self._send_single(future, data) for future, data in futures))
+        except Exception as e:
+            for future, _data in futures:
+                self._set_result(future, exc=e)
+        else:
+            for future, _data in futures:
+                self._set_result(future, result)
+
+    async def _send_single(self, future, data):
+        try:
+            result = await self._client.insert(data, timeout=self._timeout)
+        except Exception as e:
+            self._set_result(future, exc=e)
+        else:
+            self._set_result(future, result)
+
+    @staticmethod
+    def _set_result(future, result=None, exc=None):
+        if future.done():
+            return
+        if exc is None:
+            future.set_result(result)
+        else:
+            future.set_exception(exc)
+
+
+class BrokerClient:
+    '''Client for a SiriDBBroker with the same API as SiriDBClient.
+
+    A single connection to the broker is used, which is made again when a
+    request is made after the connection is lost.
+    '''
+
+    def __init__(self, path, loop=None, timeout=10):
+        self._path = path
+        self._loop = loop or asyncio.get_running_loop()
+        self._timeout = timeout
+        self._protocol = None
+        self._retry_connect = True
+
+    @property
+    def is_closed(self):
+        '''Can be used to check if close() has been called.'''
+        return not self._retry_connect
+
+    @property
+    def connected(self):
+        return self._protocol is not None and self._protocol._connected
+
+    async def connect(self, timeout=None):
+        self._retry_connect = True
+        client = self._loop.create_unix_connection(
+            lambda: _SiriDBProtocol('', '', ''),
+            path=self._path)
+        _transport, protocol = await asyncio.wait_for(
+            client,
+            timeout=timeout or self._timeout)
+        await protocol.auth_future
+        self._protocol = protocol
+
+    def close(self):
+        self._retry_connect = False
+        if self.connected:
+            self._protocol.transport.close()
+        self._protocol = None
+
+    async def insert(self, data, timeout=300):
+        if not _is_encoded(data):
+            data = encode_insert(data)
+        protocol = await self._get_protocol()
+        return await self._send(
+            protocol,
+            protomap.CPROTO_REQ_INSERT,
+            data=data,
+            is_binary=True,
+            timeout=timeout)
+
+    async def query(self, query, time_precision=None, timeout=60):
+        assert isinstance(query, (str, bytes)), \
+            'query should be of type str, unicode or bytes'
+        protocol = await self._get_protocol()
+        return await self._send(
+            protocol,
+            protomap.CPROTO_REQ_QUERY,
+            data=(query, time_precision),
+            timeout=timeout)
+
+    @staticmethod
+    async def _send(protocol, tipe, **kwargs):
+        try:
+            return await protocol.send(tipe, **kwargs)
+        except RuntimeError as e:
+            # raise the exception class which is raised by the broker
+            name, sep, msg = str(e).partition(': ')
+            if sep and name in _ERROR_CLASSES:
+                raise _ERROR_CLASSES[name](msg) from None
+            raise
+
+    async def _get_protocol(self):
+        if not self.connected:
+            if not self._retry_connect:
+                raise ConnectionError('Client is closed')
+            await self.connect()
+        return self._protocol
+
+
+def main():
+    from .client import SiriDBClient
+
+    parser = argparse.ArgumentParser(
+        description='Share SiriDB connections with local processes')
+    parser.add_argument('path', help='file name of the Unix socket')
+    parser.add_argument(
+        '--servers', default='127.0.0.1:9000',
+        help='comma separated list with host:port (default: %(default)s)')
+    parser.add_argument('--user', default='iris')
+    parser.add_argument('--password', default='siri')
+    parser.add_argument('--dbname', default='dbtest')
+    parser.add_argument(
+        '--batch-interval', type=float, default=None,
+        help='collect inserts for x seconds and send them as one insert')
+    parser.add_argument(
+        '--batch-max-bytes', type=int, default=DEFAULT_BATCH_MAX_BYTES)
+    args = parser.parse_args()
+
+    hostlist = []
+    for server in args.servers.split(','):
+        host, _, port = server.strip().rpartition(':')
+        hostlist.append((host, int(port)))
+
+    async def serve():
+        client = SiriDBClient(
+            args.user,
+            args.password,
+            args.dbname,
+            hostlist)
+        await client.connect()
+        broker = SiriDBBroker(
+            client,
+            args.path,
+            batch_interval=args.batch_interval,
+            batch_max_bytes=args.batch_max_bytes)
+        await broker.start()
+        print('SiriDB broker listening on {}'.format(args.path), flush=True)
+        try:
+            await broker._server.serve_forever()
+        finally:
+            broker.close()
+            await broker.wait_closed()
+            client.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
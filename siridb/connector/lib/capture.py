@@ -0,0 +1,249 @@
+'''Capture and replay of SiriDB client traffic.
+
+A Recorder writes timestamped outgoing and incoming packages to a compact
+binary capture file. The capture can be replayed against a SiriDB server
+(or the fake server) to reproduce the traffic pattern.
+
+File layout:
+
+    header: magic (8 bytes), wall clock start time (double)
+    record: seconds since start (double), direction (uint8), connection id
+            (uint32) followed by the package using the DataPackage header
+            layout (<IHBB) and payload
+
+Package ids are only unique per connection, so requests and responses are
+matched using the connection id and package id.
+
+Authentication requests are never captured since they contain credentials.
+
+Usage as script (replays a capture and reports latency differences):
+
+    python -m siridb.connector.lib.capture capture.bin --port 9000
+
+:copyright: 2022, Jeroen van der Heijden (Cesbit.com)
+'''
+import argparse
+import asyncio
+import random
+import struct
+import time
+from . import protomap
+from .datapackage import DataPackage
+from .logging import logger as logging
+
+
+MAGIC = b'SDBCAP01'
+
+DIRECTION_OUT = 0
+DIRECTION_IN = 1
+
+_struct_file_header = struct.Struct('<8sd')
+_struct_record = struct.Struct('<dBI')
+
+
+class Recorder:
+    '''Record packages to a capture file.
+
+    Arguments:
+        path: File name of the capture file.
+        sample_rate: Fraction of requests which are recorded, together with
+                     their responses. (default: 1.0, all requests)
+        max_bytes: Stop recording when the capture would exceed this size.
+    '''
+
+    def __init__(self, path, sample_rate=1.0, max_bytes=None):
+        self._fp = open(path, 'wb')
+        self._start = time.perf_counter()
+        self._size = _struct_file_header.size
+        self._sample_rate = sample_rate
+        self._max_bytes = max_bytes
+        self._sampled = set()
+        self._connections = 0
+        self.is_full = False
+        self._fp.write(_struct_file_header.pack(MAGIC, time.time()))
+
+    def register(self):
+        '''Returns a new connection id, used for each recorded connection.'''
+        self._connections += 1
+        return self._connections
+
+    def outgoing(self, connection, pid, tipe, header, data):
+        if tipe == protomap.CPROTO_REQ_AUTH or \
+                self._fp is None or \
+                (self._sample_rate < 1.0 and
+                 random.random() >= self._sample_rate):
+            return
+        if self._write(DIRECTION_OUT, connection, header, data):
+            self._sampled.add((connection, pid))
+
+    def incoming(self, connection, pid, barray, length):
+        if (connection, pid) not in self._sampled:
+            return
+        self._sampled.discard((connection, pid))
+        if self._fp is not None:
+            self._write(DIRECTION_IN, connection, bytes(barray[:length]))
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def _write(self, direction, connection, *data):
+        size = _struct_record.size + sum(map(len, data))
+        if self._max_bytes is not None and \
+                self._size + size > self._max_bytes:
+            if not self.is_full:
+                logging.warning(
+                    'Capture file has reached the maximum size, '
+                    'stop recording')
+                self.is_full = True
+            return False
+        self._size += size
+        self._fp.write(_struct_record.pack(
+            time.perf_counter() - self._start,
+            direction,
+            connection))
+        for d in data:
+            self._fp.write(d)
+        return True
+
+
+def read_capture(path):
+    '''Generator which yields (ts, direction, connection, pid, tipe,
+    payload) tuples.'''
+    size = DataPackage.struct_datapackage.size
+    with open(path, 'rb') as fp:
+        magic, _start = _struct_file_header.unpack(
+            fp.read(_struct_file_header.size))
+        if magic != MAGIC:
+            raise ValueError('Not a SiriDB capture file: {}'.format(path))
+        while True:
+            record = fp.read(_struct_record.size + size)
+            if len(record) < _struct_record.size + size:
+                break
+            ts, direction, connection = _struct_record.unpack_from(record)
+            length, pid, tipe, _checkbit = \
+                DataPackage.struct_datapackage.unpack_from(
+                    record, _struct_record.size)
+            payload = fp.read(length)
+            if len(payload) < length:
+                break
+            yield ts, direction, connection, pid, tipe, payload
+
+
+def _percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def replay(path, connection, speed=1.0, timeout=60):
+    '''Replay the requests of a capture using a SiriDBAsyncConnection.
+
+    Requests are sent at the original rate multiplied by `speed`. Returns a
+    dictionary with per request type the original and replayed latencies.
+    '''
+    requests, responses = [], {}
+    for ts, direction, conn, pid, tipe, payload in read_capture(path):
+        if direction == DIRECTION_OUT:
+            requests.append((ts, (conn, pid), tipe, payload))
+        else:
+            responses.setdefault((conn, pid), []).append(ts)
+
+    result = {}
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+
+    async def send(ts, key, tipe, payload):
+        # pid numbers are reused, pick the first response after the request
+        original = next(
+            (t - ts for t in responses.get(key, ()) if t >= ts), None)
+        t0 = loop.time()
+        try:
+            await connection._protocol.send(
+                tipe, payload, is_binary=True, timeout=timeout)
+        except Exception as e:
+            error = type(e).__name__
+        else:
+            error = None
+        stats = result.setdefault(
+            protomap.TEXT_REQ_MAP.get(tipe, 'UNKNOWN'),
+            {'original': [], 'replay': [], 'errors': {}})
+        stats['replay'].append(loop.time() - t0)
+        if original is not None:
+            stats['original'].append(original)
+        if error is not None:
+            stats['errors'][error] = stats['errors'].get(error, 0) + 1
+
+    tasks = []
+    offset = requests[0][0] if requests else 0.0
+    for ts, key, tipe, payload in requests:
+        delay = start + (ts - offset) / speed - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(send(ts, key, tipe, payload)))
+    await asyncio.gather(*tasks)
+    return result
+
+
+def main():
+    from .connection import SiriDBAsyncConnection
+    from .fakeserver import FakeSiriDBServer
+
+    parser = argparse.ArgumentParser(
+        description='Replay a SiriDB capture file')
+    parser.add_argument('capture')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--user', default='iris')
+    parser.add_argument('--password', default='siri')
+    parser.add_argument('--dbname', default='dbtest')
+    parser.add_argument(
+        '--speed', type=float, default=1.0,
+        help='replay rate compared to the original rate')
+    parser.add_argument(
+        '--fake', action='store_true',
+        help='replay against an in-process fake server')
+    args = parser.parse_args()
+
+    async def run():
+        server = None
+        if args.fake:
+            server = FakeSiriDBServer(
+                users={args.user: args.password},
+                dbname=args.dbname)
+            args.port = await server.start(args.host, 0)
+        connection = SiriDBAsyncConnection()
+        await connection.connect(
+            args.user,
+            args.password,
+            args.dbname,
+            host=args.host,
+            port=args.port)
+        try:
+            return await replay(args.capture, connection, args.speed)
+        finally:
+            connection.close()
+            if server is not None:
+                server.close()
+
+    result = asyncio.run(run())
+
+    print('{:<28} {:>7} {:>12} {:>12} {:>12} {:>12}  {}'.format(
+        'request', 'count', 'orig p50 ms', 'p50 ms', 'orig p99 ms',
+        'p99 ms', 'errors'))
+    for name, stats in result.items():
+        print('{:<28} {:>7} {:>12.3f} {:>12.3f} {:>12.3f} {:>12.3f}  {}'
+              .format(
+                  name,
+                  len(stats['replay']),
+                  _percentile(stats['original'], 50) * 1000,
+                  _percentile(stats['replay'], 50) * 1000,
+                  _percentile(stats['original'], 99) * 1000,
+                  _percentile(stats['replay'], 99) * 1000,
+                  stats['errors'] or '-'))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,19 +5,33 @@ SiriDB Client for python => 3.5 using asyncio.
 :copyright: 2022, Jeroen van der Heijden (Cesbit.com)
 '''
 import asyncio
+import collections
 import functools
+import json
+import operator
 import random
+import re
+import socket
 from .protocol import _SiriDBProtocol, _SiriDBConnProtocol
+from .protocol import encode_insert
 from .connection import SiriDBAsyncConnection
+from .connection import _is_encoded
+from .connection import _setup_transport
+from .connection import _setup_protocol
+from .connection import _on_connected
+from .tail import Tail
 from .exceptions import ServerError
 from .exceptions import PoolError
 from .constants import SECOND
 from .constants import MICROSECOND
 from .constants import MILLISECOND
 from .constants import NANOSECOND
+from .constants import PRIORITY_INTERACTIVE
+from .constants import PRIORITY_BULK
 from .protomap import CPROTO_REQ_QUERY
 from .protomap import CPROTO_REQ_INSERT
 from .protomap import CPROTO_REQ_PING
+from .defaults import DEFAULT_CLIENT_PORT
 from .logging import logger as logging
 
 
@@ -47,6 +61,230 @@ class _SiriDBClientProtocol(_SiriDBProtocol):
             loop.call_later(self._inactive_time, self.set_available)
 
 
+def _quote(value):
+    '''Return a value as literal which can be used in a query.'''
+    if isinstance(value, str):
+        return '"{}"'.format(value.replace('"', '""'))
+    return str(value)
+
+
+class _InsertEncoder:
+    '''Encode insert data using an executor.
+
+    Encoding may finish out-of-order when using a pool of workers, so each
+    encoded result is only returned after the results of all previous calls
+    are returned. This makes sure inserts are written in the order they are
+    made.
+    '''
+
+    def __init__(self, loop, executor):
+        self._loop = loop
+        self._executor = executor
+        self._last = None
+
+    async def encode(self, data):
+        prev, fut = self._last, self._loop.create_future()
+        self._last = fut
+        try:
+            data = await self._loop.run_in_executor(
+                self._executor,
+                encode_insert,
+                data)
+            if prev is not None:
+                await asyncio.shield(prev)
+        finally:
+            if prev is None or prev.done():
+                fut.set_result(None)
+            else:
+                prev.add_done_callback(lambda _: fut.set_result(None))
+        return data
+
+
+# single series select queries which can be combined; only a time range
+# may follow the series name and neither part may rename or merge series
+_RE_BATCH_QUERY = re.compile(
+    r'\s*select\s+(?P<select>.+?)\s+from\s+"(?P<series>(?:[^"]|"")*)"'
+    r'(?P<range>\s+(?:after|before|between)\s.*?)?\s*',
+    re.IGNORECASE | re.DOTALL)
+
+_RE_RENAME = re.compile(r'\b(?:prefix|suffix|merge)\b', re.IGNORECASE)
+
+# selects which can be split in sub-ranges by query_range(); an aggregation
+# needs a group by interval so each sub-range yields complete groups
+_RE_RANGE_SELECT = re.compile(
+    r'\s*(?:\*|(?P<agg>\w+)\s*\(\s*(?P<group_by>\d+)\s*\))\s*')
+
+
+class _QueryBatcher:
+    '''Combine single series queries which are made within a short window.
+
+    Queries with the same select expression, time range, time precision
+    and priority are sent as one query for all series. The result is split
+    by series. When the combined query fails, each query is sent on its
+    own so every caller receives its own result or error.
+    '''
+
+    def __init__(self, loop, send_query, window, max_series):
+        assert window > 0, 'query_batch_window should be a positive number'
+        assert max_series > 1, \
+            'query_batch_max_series should be an integer larger than 1'
+        self._loop = loop
+        self._send_query = send_query
+        self._window = window
+        self._max_series = max_series
+        self._batches = {}
+
+    @staticmethod
+    def match(query):
+        '''Returns a match when a query can be combined, else None.'''
+        if not isinstance(query, str):
+            return None
+        m = _RE_BATCH_QUERY.fullmatch(query)
+        if m is None or _RE_RENAME.search(m.group('select')) or \
+                _RE_RENAME.search(m.group('range') or ''):
+            return None
+        return m
+
+    def query(self, m, query, time_precision, timeout, priority):
+        key = (
+            m.group('select').strip(),
+            (m.group('range') or '').strip(),
+            time_precision,
+            priority)
+        batch = self._batches.get(key)
+        if batch is None:
+            handle = self._loop.call_later(self._window, self._flush, key)
+            batch = self._batches[key] = (handle, [])
+        future = self._loop.create_future()
+        name = m.group('series').replace('""', '"')
+        batch[1].append((name, query, timeout, future))
+        if len({entry[0] for entry in batch[1]}) >= self._max_series:
+            batch[0].cancel()
+            self._flush(key)
+        return future
+
+    def _flush(self, key):
+        _handle, entries = self._batches.pop(key)
+        asyncio.ensure_future(self._run(key, entries))
+
+    def close(self):
+        batches, self._batches = self._batches, {}
+        for handle, entries in batches.values():
+            handle.cancel()
+            for *_, future in entries:
+                if not future.done():
+                    future.set_exception(ConnectionError('Client is closed'))
+
+    async def _run(self, key, entries):
+        select, time_range, time_precision, priority = key
+        names = list(dict.fromkeys(entry[0] for entry in entries))
+        if len(names) == 1:
+            await self._run_single(entries, time_precision, priority)
+            return
+
+        query = 'select {} from {}{}'.format(
+            select,
+            ', '.join(_quote(name) for name in names),
+            ' ' + time_range if time_range else '')
+        try:
+            result = await self._send_query(
+                query,
+                time_precision,
+                max(entry[2] for entry in entries),
+                priority,
+                False)
+        except Exception as e:
+            logging.debug('Combined query failed with error {!r}, sending '
+                          'the queries one by one...'.format(e))
+            await self._run_single(entries, time_precision, priority)
+            return
+
+        if not all(name in result for name in names):
+            logging.debug('Combined query result does not contain all '
+                          'series, sending the queries one by one...')
+            await self._run_single(entries, time_precision, priority)
+            return
+
+        seen = set()
+        for name, _query, _timeout, future in entries:
+            if future.done():
+                continue
+            points = result[name]
+            # callers for the same series each get their own list
+            future.set_result({
+                name: list(points) if name in seen else points})
+            seen.add(name)
+
+    async def _run_single(self, entries, time_precision, priority):
+        async def run(query, timeout, future):
+            try:
+                result = await self._send_query(
+                    query, time_precision, timeout, priority, False)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+        await asyncio.gather(*(
+            run(query, timeout, future)
+            for _name, query, timeout, future in entries))
+
+
+class _NowaitInserts:
+    '''Inserts which are sent without waiting for the response.
+
+    At most `window` inserts are in flight. Failures are passed to the
+    `on_error` callback as (exception, data) or, when no callback is given,
+    are put on the `errors` queue.
+    '''
+
+    def __init__(self, insert, window, on_error, max_errors):
+        assert window > 0, 'nowait_window should be a positive integer'
+        self._insert = insert
+        self._window = window
+        self._on_error = on_error
+        self._pending = set()
+        self.errors = asyncio.Queue(max_errors)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def insert(self, data, timeout):
+        if len(self._pending) >= self._window:
+            raise asyncio.QueueFull(
+                'Too many pending inserts (nowait_window: {})'
+                .format(self._window))
+        task = asyncio.ensure_future(self._insert(data, timeout=timeout))
+        task.data = data
+        self._pending.add(task)
+        task.add_done_callback(self._on_done)
+
+    def _on_done(self, task):
+        self._pending.discard(task)
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is None:
+            return
+        if self._on_error is not None:
+            try:
+                self._on_error(exc, task.data)
+            except Exception as e:
+                logging.exception(e)
+            return
+        try:
+            self.errors.put_nowait((exc, task.data))
+        except asyncio.QueueFull:
+            logging.error('Insert failed and the error queue is full: {}'
+                          .format(str(exc) or type(exc).__name__))
+
+    async def flush(self):
+        while self._pending:
+            await asyncio.wait(set(self._pending))
+
+
 # never wait more than x seconds before trying to connect again
 DEFAULT_MAX_WAIT_RETRY = 90
 
@@ -57,6 +295,30 @@ DEFAULT_CONNECT_TIMEOUT = 10
 # the inactive status.
 DEFAULT_INACTIVE_TIME = 30
 
+# number of rows which are requested per page when using iter_list()
+DEFAULT_PAGE_SIZE = 10000
+
+# maximum number of sub-range queries which run at the same time when using
+# query_range()
+DEFAULT_RANGE_CONCURRENCY = 4
+
+# maximum number of inserts made with insert_nowait() which are in flight
+DEFAULT_NOWAIT_WINDOW = 1000
+
+# failed inserts made with insert_nowait() which are kept on the error queue
+# when no error callback is used; more errors are only logged
+DEFAULT_NOWAIT_ERRORS = 1000
+
+# maximum number of series in a combined query when query_batch_window is
+# used
+DEFAULT_QUERY_BATCH_MAX_SERIES = 100
+
+# aggregate functions which can be used with query_resolution() and
+# query_range()
+RESOLUTION_AGGREGATES = (
+    'mean', 'median', 'median_low', 'median_high', 'sum', 'min', 'max',
+    'count', 'first', 'last', 'variance', 'pvariance', 'stddev')
+
 
 class SiriDBClient:
     '''
@@ -79,6 +341,10 @@ class SiriDBClient:
         - TypeError
             Raised when an unknown package is received. (might be caused
             by running a different SiriDB version)
+        - PackageError
+            Raised when the response for a request is received but cannot
+            be read, for example due to a corrupt package. It is not known
+            if the request was processed by SiriDB.
         - RuntimeError
             Raised when a general error message is received. This should not
             happen unless a new bug is discovered.
@@ -89,6 +355,10 @@ class SiriDBClient:
             The user as no rights to perform the insert or query.
     '''
 
+    # a lost connection which was connected for at least x seconds is
+    # reconnected right away, without waiting for its backoff
+    HEALTHY_TIME = 60
+
     def __init__(self,
                  username,
                  password,
@@ -98,7 +368,21 @@ class SiriDBClient:
                  keepalive=True,
                  timeout=DEFAULT_CONNECT_TIMEOUT,
                  inactive_time=DEFAULT_INACTIVE_TIME,
-                 max_wait_retry=DEFAULT_MAX_WAIT_RETRY):
+                 max_wait_retry=DEFAULT_MAX_WAIT_RETRY,
+                 executor=None,
+                 sockopts=None,
+                 write_buffer_limits=None,
+                 metrics=None,
+                 recorder=None,
+                 discovery_interval=None,
+                 discovery_cache=None,
+                 discovery_port=DEFAULT_CLIENT_PORT,
+                 bulk_concurrency=None,
+                 response_limits=None,
+                 nowait_window=DEFAULT_NOWAIT_WINDOW,
+                 on_insert_error=None,
+                 query_batch_window=None,
+                 query_batch_max_series=DEFAULT_QUERY_BATCH_MAX_SERIES):
         '''Initialize.
         Arguments:
             username: User with permissions to use the database.
@@ -111,7 +395,8 @@ class SiriDBClient:
                       [
                           ('server1.local', 9000, {'weight': 3}),
                           ('server2.local', 9000),
-                          ('backup1.local', 9000, {'backup': True})
+                          ('backup1.local', 9000, {'backup': True}),
+                          ('bulk1.local', 9000, {'bulk': True})
                       ]
 
                       Each server should at least has a hostname and port
@@ -126,6 +411,10 @@ class SiriDBClient:
                                  server will be marked as backup server and
                                  will only be chosen if no other server is
                                  available. (default: False)
+                      - bulk : Should be either True or False. When True the
+                               server is preferred for bulk requests and is
+                               only used for interactive requests if no
+                               other server is available. (default: False)
 
         Keyword arguments:
             loop: Asyncio loop. When None the default event loop will be used.
@@ -137,29 +426,106 @@ class SiriDBClient:
             max_wait_retry: When the reconnect loop starts, we try to reconnect
                             in a seconds, then 2 seconds, 4, 8 and so on until
                             max_wait_retry is reached and then use this value
-                            to retry again.
+                            to retry again. The backoff is tracked for each
+                            server and a random jitter is added.
+            executor: When given, insert data is encoded using this executor
+                      instead of on the event loop. Use a process pool
+                      executor when encoding is a bottleneck. Data which is
+                      already encoded using encode_insert() is never
+                      encoded again.
+            sockopts: Socket options which are applied to each connection.
+                      Must be an iterable with (level, optname, value) tuples,
+                      for example:
+                      [(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)]
+            write_buffer_limits: Tuple (high, low) with the write buffer
+                                 water marks for each connection. Requests
+                                 wait while the write buffer is above the
+                                 high water mark until it is drained below
+                                 the low water mark.
+            metrics: Optional metrics.Metrics instance which is used to
+                     record metrics for all connections.
+            recorder: Optional capture.Recorder instance which is used to
+                      record the traffic of all connections.
+            response_limits: Tuple (spill_size, max_size) with limits in
+                             bytes for a single response, either may be
+                             None. Query responses larger than spill_size
+                             are written to a temporary file and returned
+                             as a memory-mapped LazyResult. Requests with
+                             a response larger than max_size fail with a
+                             PackageError.
+            discovery_interval: When set, the servers in the cluster are
+                                discovered on connect and every x seconds
+                                using `list servers`. Connections to new
+                                servers are added and connections to
+                                discovered servers which are removed from
+                                the cluster are closed. Servers from the
+                                hostlist keep their weight and backup options
+                                and are never removed.
+            discovery_cache: Optional file name where discovered servers are
+                             stored. On connect, servers from this file are
+                             used without waiting for a discovery first.
+            discovery_port: Client port used for discovered servers since
+                            SiriDB does not report the client port.
+            bulk_concurrency: When set, at most x bulk requests are sent
+                              at the same time. Other bulk requests wait
+                              while interactive requests are not limited.
+            nowait_window: Maximum number of inserts made with
+                           insert_nowait() which wait for a response.
+            on_insert_error: Optional callback which is called with
+                             (exception, data) when an insert made with
+                             insert_nowait() fails. When not given, errors
+                             are put on the `insert_errors` queue.
+            query_batch_window: When set, single series queries like
+                                `select last() from "x"` which are made
+                                within x seconds are combined into one
+                                query, when they use the same select
+                                expression and time range.
+            query_batch_max_series: A combined query is sent right away
+                                    when it reaches this number of series.
         '''
         self._username = username
         self._password = password
         self._dbname = dbname
         self._connection_pool = []
+        self._connections = set()
         self._keepalive = keepalive
         for host, port, *config in hostlist:
             config = config.pop() if config else {}
-            client = SiriDBAsyncConnection()
-            client.host = host
-            client.port = port
-            client.is_backup = config.get('backup', False)
-            client.weight = config.get('weight', 1)
-            assert 0 < client.weight < 10, \
-                'weight should be value between 1 and 9'
-            for _ in range(client.weight):
-                self._connection_pool.append(client)
-        self._connections = set(self._connection_pool)
+            self._add_connection(
+                host,
+                port,
+                weight=config.get('weight', 1),
+                backup=config.get('backup', False),
+                bulk=config.get('bulk', False))
         self._loop = loop or asyncio.get_running_loop()
+        self._encoder = None if executor is None else \
+            _InsertEncoder(self._loop, executor)
         self._timeout = timeout
+        self._sockopts = sockopts
+        self._write_buffer_limits = write_buffer_limits
+        self._metrics = metrics
+        self._recorder = recorder
+        self._response_limits = response_limits
         self._connect_task = None
+        self._connect_event = asyncio.Event()
+        self._discovery_interval = discovery_interval
+        self._discovery_cache = discovery_cache
+        self._discovery_port = discovery_port
+        self._discovery_task = None
         self._max_wait_retry = max_wait_retry
+        self._bulk_semaphore = None if bulk_concurrency is None else \
+            asyncio.Semaphore(bulk_concurrency)
+        self._nowait = _NowaitInserts(
+            self.insert,
+            nowait_window,
+            on_insert_error,
+            DEFAULT_NOWAIT_ERRORS)
+        self._query_batcher = None if query_batch_window is None else \
+            _QueryBatcher(
+                self._loop,
+                self._send_query,
+                query_batch_window,
+                query_batch_max_series)
         self._protocol = \
             functools.partial(_SiriDBClientProtocol,
                               trigger_connect=self._trigger_connect,
@@ -184,9 +550,15 @@ class SiriDBClient:
 
     async def connect(self, timeout=None):
         self._retry_connect = True
+        if self._discovery_interval is not None:
+            await self._load_discovery_cache()
         result = await self._connect(timeout)
         if result and set(result) - {None} and self._connect_task is None:
             self._connect_task = asyncio.ensure_future(self._connect_loop())
+        if self._discovery_interval is not None and \
+                self._discovery_task is None:
+            self._discovery_task = \
+                asyncio.ensure_future(self._discovery_loop())
         return result
 
     def close(self):
@@ -194,54 +566,128 @@ class SiriDBClient:
         if self._connect_task is not None:
             self._connect_task.cancel()
             self._connect_task = None
+        if self._discovery_task is not None:
+            self._discovery_task.cancel()
+            self._discovery_task = None
+        if self._query_batcher is not None:
+            self._query_batcher.close()
         for connection in self._connections:
             if connection.connected:
                 connection.close()
 
-    async def insert(self, data, timeout=300):
+    async def insert(self, data, timeout=300, priority=PRIORITY_BULK):
+        if self._encoder is not None and not _is_encoded(data):
+            data = await self._encoder.encode(data)
+        if priority == PRIORITY_BULK and self._bulk_semaphore is not None:
+            async with self._bulk_semaphore:
+                return await self._insert(data, timeout, priority)
+        return await self._insert(data, timeout, priority)
+
+    def insert_nowait(self, data, timeout=300):
+        '''Insert without waiting for the response.
+
+        Raises asyncio.QueueFull when `nowait_window` inserts are pending.
+        Failures are reported using the `on_insert_error` callback or the
+        `insert_errors` queue. Use flush() to wait for pending inserts.
+        '''
+        self._nowait.insert(data, timeout)
+
+    async def flush(self):
+        '''Wait until all inserts made with insert_nowait() are done.'''
+        await self._nowait.flush()
+
+    @property
+    def insert_errors(self):
+        '''Queue with (exception, data) tuples for failed inserts which are
+        made with insert_nowait(), when no error callback is used.'''
+        return self._nowait.errors
+
+    @property
+    def pending_inserts(self):
+        '''Number of inserts made with insert_nowait() which are pending.'''
+        return len(self._nowait)
+
+    async def _insert(self, data, timeout, priority):
         end = self._loop.time() + timeout
         while True:
-            connection = self._get_random_connection()
+            connection = self._get_random_connection(priority=priority)
 
             try:
-                result = await connection.insert(data, timeout)
+                result = await connection.insert(data, timeout, priority)
             except (ConnectionError, ServerError) as e:
                 logging.debug('Insert failed with error {!r}, trying another '
                               'server if one is available...'.format(e))
                 if connection._protocol:
                     connection._protocol.set_not_available(self._loop)
+                self._count_retry(connection, CPROTO_REQ_INSERT)
             except PoolError as e:
                 if self._loop.time() > end:
                     raise
+                self._count_retry(connection, CPROTO_REQ_INSERT)
                 msg = str(e) or type(e).__name__
                 logging.debug(msg)
                 await asyncio.sleep(2)
             else:
                 return result
 
-    async def query(self, query, time_precision=None, timeout=60):
+    async def query(self,
+                    query,
+                    time_precision=None,
+                    timeout=60,
+                    priority=PRIORITY_INTERACTIVE,
+                    lazy=False):
+        '''Query SiriDB.
+
+        When `lazy` is True, the result is returned as LazyResult, a
+        read-only mapping which only decodes the points of a series when
+        the series is accessed. Lazy queries are never combined when
+        query_batch_window is used.
+        '''
         assert isinstance(query, (str, bytes)), \
             'query should be of type str, unicode or bytes'
 
         assert time_precision is None or isinstance(time_precision, int), \
             'time_precision should be None or an int type.'
 
+        if self._query_batcher is not None and not lazy:
+            m = self._query_batcher.match(query)
+            if m is not None:
+                return await self._query_batcher.query(
+                    m, query, time_precision, timeout, priority)
+        return await self._send_query(
+            query, time_precision, timeout, priority, lazy)
+
+    async def _send_query(self, query, time_precision, timeout, priority,
+                          lazy):
+        if priority == PRIORITY_BULK and self._bulk_semaphore is not None:
+            async with self._bulk_semaphore:
+                return await self._query(
+                    query, time_precision, timeout, priority, lazy)
+        return await self._query(
+            query, time_precision, timeout, priority, lazy)
+
+    async def _query(self, query, time_precision, timeout, priority, lazy):
         end = self._loop.time() + timeout
         try_unavailable = True
         while True:
-            connection = self._get_random_connection(try_unavailable)
+            connection = self._get_random_connection(try_unavailable,
+                                                     priority)
             try:
                 result = await connection.query(query,
                                                 time_precision=time_precision,
-                                                timeout=timeout)
+                                                timeout=timeout,
+                                                priority=priority,
+                                                lazy=lazy)
             except (ConnectionError, ServerError) as e:
                 logging.debug('Query failed with error {!r}, trying another '
                               'server if one is available...'.format(e))
                 if connection._protocol:
                     connection._protocol.set_not_available(self._loop)
+                self._count_retry(connection, CPROTO_REQ_QUERY)
             except PoolError as e:
                 if self._loop.time() > end:
                     raise
+                self._count_retry(connection, CPROTO_REQ_QUERY)
                 msg = str(e) or type(e).__name__
                 logging.debug(msg)
                 await asyncio.sleep(2)
@@ -251,7 +697,346 @@ class SiriDBClient:
             # only try unavailable once
             try_unavailable = False
 
-    async def _connect(self, timeout=None):  # the one that actually connects
+    async def query_range(self,
+                          series,
+                          start,
+                          end,
+                          interval,
+                          select='*',
+                          concurrency=DEFAULT_RANGE_CONCURRENCY,
+                          time_precision=None,
+                          timeout=60):
+        '''Query a time range using multiple smaller queries.
+
+        The range is split in sub-ranges of `interval` which are queried at
+        the same time, at most `concurrency` at once. The result is the same
+        as `select <select> from <series> between <start> and <end>`, with
+        the points for each series merged in order.
+
+        The `select` argument must be `*` or an aggregation with a group by
+        interval, for example `mean(60)`, using one of the functions in
+        RESOLUTION_AGGREGATES. For an aggregation, `interval` must be a
+        multiple of the group by interval and the sub-ranges are aligned to
+        the groups, so no group is split. Other selects, such as `last()`
+        or `difference()`, cannot be split in sub-ranges and are rejected.
+
+        Arguments start, end and interval must be integer values using the
+        time precision of the database. The `series` argument is used as-is
+        so it may be a series name between double quotes or a regular
+        expression.
+        '''
+        result = {}
+        async for chunk in self.iter_query_range(
+                series,
+                start,
+                end,
+                interval,
+                select=select,
+                concurrency=concurrency,
+                time_precision=time_precision,
+                timeout=timeout):
+            for name, points in chunk.items():
+                if name in result:
+                    result[name].extend(points)
+                else:
+                    result[name] = points
+        return result
+
+    async def iter_query_range(self,
+                               series,
+                               start,
+                               end,
+                               interval,
+                               select='*',
+                               concurrency=DEFAULT_RANGE_CONCURRENCY,
+                               time_precision=None,
+                               timeout=60):
+        '''Like query_range() but yields the result for each sub-range.
+
+        Results are yielded in time order, as soon as they are available.
+        Only `concurrency` results are kept pending at once so memory usage
+        is bounded when the results are consumed slower than they arrive.
+        '''
+        assert interval > 0, 'interval should be a positive integer'
+        assert concurrency > 0, 'concurrency should be a positive integer'
+        m = _RE_RANGE_SELECT.fullmatch(select)
+        assert m is not None and (
+            m.group('agg') is None or
+            m.group('agg') in RESOLUTION_AGGREGATES), \
+            'select should be * or an aggregation with a group by interval'
+        group_by = 1 if m.group('agg') is None else int(m.group('group_by'))
+        assert group_by > 0 and interval % group_by == 0, \
+            'interval should be a multiple of the group by interval'
+
+        async def query(sub_start, sub_end):
+            return await self.query(
+                'select {} from {} between {} and {}'.format(
+                    select, series, sub_start, sub_end),
+                time_precision=time_precision,
+                timeout=timeout)
+
+        # a group ends at a multiple of group_by, so after the first
+        # sub-range, each sub-range starts right after the end of a group
+        sub_start = start
+        sub_end = start + ((1 - start) % group_by or interval)
+        pending = collections.deque()
+        try:
+            while sub_start < end:
+                sub_end = min(sub_end, end)
+                pending.append(
+                    asyncio.ensure_future(query(sub_start, sub_end)))
+                sub_start, sub_end = sub_end, sub_end + interval
+                if len(pending) >= concurrency:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def query_resolution(self,
+                               series,
+                               start,
+                               end,
+                               max_points,
+                               agg='mean',
+                               time_precision=None,
+                               timeout=60):
+        '''Query a time range with at most `max_points` points per series.
+
+        An aggregation interval is chosen so the range is covered by at most
+        `max_points` buckets, and `select <agg>(<interval>) from <series>
+        between <start> and <end>` is sent using query().
+
+        Arguments start and end must be integer values using the time
+        precision of the database. The `series` argument is used as-is so it
+        may be a series name between double quotes or a regular expression.
+        '''
+        assert agg in RESOLUTION_AGGREGATES, \
+            'agg should be one of: {}'.format(', '.join(RESOLUTION_AGGREGATES))
+        assert max_points >= 2, 'max_points should be at least 2'
+        assert end > start, 'end should be greater than start'
+
+        # SiriDB aligns the buckets at multiples of the interval, so a range
+        # may start and end in a partial bucket
+        interval = -(-(end - start) // (max_points - 1))
+        return await self.query(
+            'select {}({}) from {} between {} and {}'.format(
+                agg, interval, series, start, end),
+            time_precision=time_precision,
+            timeout=timeout)
+
+    def tail(self, series, interval, window, lag=0, timeout=60):
+        '''Returns an asynchronous iterator which yields new points.
+
+        Every `interval` seconds, `series` is queried for points after the
+        newest timestamp seen, minus `lag`. Each iteration yields a
+        dictionary with only the new points per series. The points of the
+        last `window` are kept in memory and can be read using the window()
+        method of the returned Tail.
+
+        Arguments window and lag must be integer values using the time
+        precision of the database. The `series` argument is used as-is so it
+        may be a series name between double quotes or a regular expression.
+        '''
+        return Tail(self, series, interval, window, lag=lag, timeout=timeout)
+
+    async def iter_list(self,
+                        what='series',
+                        columns=('name',),
+                        where=None,
+                        page_size=DEFAULT_PAGE_SIZE,
+                        key='name',
+                        timeout=60):
+        '''Asynchronous iterator which yields a list query in pages.
+
+        Each page is a list with at most `page_size` rows, sorted by `key`,
+        and is yielded as soon as it arrives. An optional `where` expression
+        is used as-is, for example: `'name ~ /cpu.*/'`.
+
+        Pages are requested using the `limit` and a filter on the `key`
+        column, which must be a unique column and part of the columns. One
+        more row than `page_size` is requested, so a range is known to be
+        complete when fewer rows are returned. A page is therefore confirmed
+        using a list query for the range up to its highest key, which costs
+        one extra list query per page when the server returns the lowest
+        keys first. When the server returns rows in arbitrary order, the
+        range is halved until it is complete, which costs about
+        log2(matching rows / page_size) extra list queries for each page.
+        '''
+        assert page_size > 1, 'page_size should be at least 2'
+        columns = list(columns)
+        assert key in columns, 'key should be one of the columns'
+        get_key = operator.itemgetter(columns.index(key))
+
+        def condition(lower, upper):
+            conditions = [] if where is None else ['({})'.format(where)]
+            if lower is not None:
+                conditions.append('{} > {}'.format(key, _quote(lower)))
+            if upper is not None:
+                conditions.append('{} <= {}'.format(key, _quote(upper)))
+            return ' where {}'.format(' and '.join(conditions)) \
+                if conditions else ''
+
+        async def fetch(lower, upper):
+            result = await self.query(
+                'list {} {}{} limit {}'.format(
+                    what,
+                    ', '.join(columns),
+                    condition(lower, upper),
+                    page_size + 1),
+                timeout=timeout)
+            rows = result[what]
+            rows.sort(key=get_key)
+            return rows
+
+        lower = None
+        while True:
+            upper = None
+            rows = await fetch(lower, upper)
+            while len(rows) > page_size:
+                # the range is not complete; limit the range to the highest
+                # key of a page, or to half of it when the range was already
+                # limited to a page
+                upper = get_key(rows[
+                    page_size - 1 if upper is None else (page_size - 1) // 2])
+                rows = await fetch(lower, upper)
+            if rows:
+                yield rows
+            if upper is None:
+                break
+            lower = upper
+
+    def _add_connection(self,
+                        host,
+                        port,
+                        weight=1,
+                        backup=False,
+                        bulk=False,
+                        is_discovered=False):
+        assert 0 < weight < 10, 'weight should be value between 1 and 9'
+        connection = SiriDBAsyncConnection()
+        connection.host = host
+        connection.port = port
+        connection.is_backup = backup
+        connection.is_bulk = bulk
+        connection.weight = weight
+        connection.is_discovered = is_discovered
+        connection.connected_at = None
+        connection.retry_at = None
+        connection.retry_wait = 0
+        for _ in range(weight):
+            self._connection_pool.append(connection)
+        self._connections.add(connection)
+        return connection
+
+    def _remove_connection(self, connection):
+        self._connections.discard(connection)
+        self._connection_pool = [
+            c for c in self._connection_pool if c is not connection]
+        if connection.connected:
+            connection.close()
+
+    async def _resolve(self, host, port):
+        try:
+            infos = await self._loop.getaddrinfo(
+                host, port, type=socket.SOCK_STREAM)
+        except OSError as e:
+            logging.debug('Failed to resolve {}:{}: {}'
+                          .format(host, port, str(e) or type(e).__name__))
+            return set()
+        return {(info[4][0], port) for info in infos}
+
+    async def _known_addresses(self):
+        # servers report their address, while a hostlist may use a hostname,
+        # so the resolved addresses are compared as well
+        connections = list(self._connections)
+        resolved = await asyncio.gather(*(
+            self._resolve(c.host, c.port) for c in connections))
+        known = {(c.host, c.port) for c in connections}
+        return known.union(*resolved)
+
+    async def _load_discovery_cache(self):
+        if self._discovery_cache is None:
+            return
+        try:
+            with open(self._discovery_cache, 'r') as f:
+                servers = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.warning('Failed to read the discovery cache: {}'
+                            .format(str(e) or type(e).__name__))
+            return
+        known = await self._known_addresses()
+        for host, port in servers:
+            if (host, port) not in known:
+                self._add_connection(host, port, is_discovered=True)
+
+    def _save_discovery_cache(self):
+        if self._discovery_cache is None:
+            return
+        servers = sorted(
+            [c.host, c.port] for c in self._connections if c.is_discovered)
+        try:
+            with open(self._discovery_cache, 'w') as f:
+                json.dump(servers, f)
+        except Exception as e:
+            logging.warning('Failed to write the discovery cache: {}'
+                            .format(str(e) or type(e).__name__))
+
+    async def _discover(self):
+        result = await self.query('list servers address, online')
+        online = {
+            (address, self._discovery_port): is_online
+            for address, is_online in result['servers']}
+        known = {(c.host, c.port): c for c in self._connections}
+        addresses = await self._known_addresses()
+
+        added = []
+        for (host, port), is_online in online.items():
+            if is_online and (host, port) not in addresses:
+                logging.info('Discovered SiriDB server {}:{}'
+                             .format(host, port))
+                added.append(
+                    self._add_connection(host, port, is_discovered=True))
+
+        for key, connection in known.items():
+            if connection.is_discovered and key not in online:
+                logging.info('SiriDB server {}:{} is removed from the cluster'
+                             .format(*key))
+                self._remove_connection(connection)
+
+        self._save_discovery_cache()
+        if added:
+            # other connections are handled by the reconnect loop, which
+            # also schedules retries for new servers which fail to connect
+            result = await self._connect(connections=added)
+            if result and set(result) - {None}:
+                self._trigger_connect()
+
+    async def _discovery_loop(self):
+        try:
+            while True:
+                try:
+                    await self._discover()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.error('Failed to discover SiriDB servers: {}'
+                                  .format(str(e) or type(e).__name__))
+                await asyncio.sleep(self._discovery_interval)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._discovery_task = None
+
+    async def _connect(self, timeout=None, connections=None):
+        # the one that actually connects
+        connections = [
+            connection
+            for connection in (connections or self._connections)
+            if not connection.connected]
         tasks = [
             connection.connect(
                 self._username,
@@ -262,46 +1047,120 @@ class SiriDBClient:
                 loop=self._loop,
                 keepalive=self._keepalive,
                 timeout=timeout or self._timeout,
-                protocol=self._protocol)
-            for connection in self._connections
-            if not connection.connected]
+                protocol=self._protocol,
+                sockopts=self._sockopts,
+                write_buffer_limits=self._write_buffer_limits,
+                metrics=self._metrics,
+                recorder=self._recorder,
+                response_limits=self._response_limits)
+            for connection in connections]
         if not tasks:
             return
         logging.debug('Trying to connect to {} servers...'
                       .format(len(tasks)))
         result = await asyncio.gather(*tasks, return_exceptions=True)
+        now = self._loop.time()
+        for connection in connections:
+            if connection.connected:
+                connection.connected_at = now
+                connection.retry_at = None
         self._log_connect_result(result)
         return result
 
+    def _schedule_reconnect(self, connection, now):
+        if connection.connected_at is not None and \
+                now - connection.connected_at >= self.HEALTHY_TIME:
+            # the connection was healthy, so try to reconnect right away
+            connection.retry_wait = 0
+            connection.retry_at = now
+        else:
+            connection.retry_wait = min(
+                max(1, connection.retry_wait * 2),
+                self._max_wait_retry)
+            # add jitter so clients do not reconnect at the same moment
+            connection.retry_at = \
+                now + connection.retry_wait * random.uniform(0.5, 1.0)
+        connection.connected_at = None
+
     async def _connect_loop(self):  # the one that looks for connections
-        sleep = 1
         try:
-            while [connection
-                   for connection in self._connections
-                   if not connection.connected]:
-                logging.debug('Reconnecting in {} seconds...'.format(sleep))
-                await asyncio.sleep(sleep)
-                if self._connect_task is None:
+            while True:
+                now = self._loop.time()
+                disconnected = [
+                    connection
+                    for connection in self._connections
+                    if not connection.connected]
+                if not disconnected:
                     break
-                await self._connect()
+
+                for connection in disconnected:
+                    if connection.retry_at is None:
+                        self._schedule_reconnect(connection, now)
+
+                due = [
+                    connection
+                    for connection in disconnected
+                    if connection.retry_at <= now]
+                if due:
+                    await self._connect(connections=due)
+                    if self._connect_task is None:
+                        break
+                    now = self._loop.time()
+                    for connection in due:
+                        if not connection.connected:
+                            self._schedule_reconnect(connection, now)
+                    continue
+
+                sleep = min(
+                    connection.retry_at
+                    for connection in disconnected) - now
+                logging.debug(
+                    'Reconnecting in {:.1f} seconds...'.format(sleep))
+                # wait for the next retry or for another lost connection
+                self._connect_event.clear()
+                try:
+                    await asyncio.wait_for(
+                        self._connect_event.wait(),
+                        timeout=sleep)
+                except asyncio.TimeoutError:
+                    pass
                 if self._connect_task is None:
                     break
-                sleep = min(sleep * 2, self._max_wait_retry)
         except asyncio.CancelledError:
             pass
         finally:
             self._connect_task = None
 
+    def _count_retry(self, connection, tipe):
+        if self._metrics is not None:
+            self._metrics.server(
+                '{}:{}'.format(connection.host, connection.port)
+            ).request(tipe).retries += 1
+
     def _trigger_connect(self):
-        if self._retry_connect and self._connect_task is None:
+        if not self._retry_connect:
+            return
+        if self._connect_task is None:
             self._connect_task = asyncio.ensure_future(self._connect_loop())
+        else:
+            self._connect_event.set()
 
-    def _get_random_connection(self, try_unavailable=False):
+    def _get_random_connection(self, try_unavailable=False, priority=None):
         available = \
             [connection
              for connection in self._connection_pool
              if connection._protocol and connection._protocol._is_available]
 
+        if priority is not None:
+            # bulk requests prefer bulk servers, other requests avoid them
+            is_bulk = priority == PRIORITY_BULK
+            preferred = \
+                [connection
+                 for connection in available
+                 if connection.is_bulk == is_bulk]
+            if preferred:
+                available = preferred
+
         non_backups = \
             [connection
              for connection in available
@@ -332,6 +1191,7 @@ class SiriDBConn:
     MAX_RECONNECT_TIMEOUT = 10
     MAX_WRITE_RETRY = 120
     RECONNECT_ATTEMPT = 3
+    STANDBY_PING_INTERVAL = 30
 
     def __init__(self,
                  username,
@@ -339,34 +1199,178 @@ class SiriDBConn:
                  dbname,
                  server,
                  port=9000,
-                 loop=None):
+                 loop=None,
+                 executor=None,
+                 sockopts=None,
+                 write_buffer_limits=None,
+                 metrics=None,
+                 recorder=None,
+                 response_limits=None,
+                 standby=False,
+                 standby_server=None,
+                 standby_port=None,
+                 nowait_window=DEFAULT_NOWAIT_WINDOW,
+                 on_insert_error=None):
+        '''Initialize.
+
+        When standby is True, a second connection is kept authenticated
+        and is used right away when the active connection is lost. The
+        standby connects to standby_server and standby_port, or to the same
+        server when not given. After a failover the roles are swapped: the
+        standby server is the active server and a new standby is connected
+        in the background to the server which was lost, with a backoff.
+
+        The response_limits argument is a (spill_size, max_size) tuple, see
+        SiriDBClient.
+
+        Inserts made with insert_nowait() are limited by nowait_window and
+        failures are reported using on_insert_error, see SiriDBClient.
+        '''
         self._username = username
         self._password = password
         self._dbname = dbname
         self._server = server
         self._port = port
         self._loop = loop or asyncio.get_running_loop()
+        self._encoder = None if executor is None else \
+            _InsertEncoder(self._loop, executor)
+        self._sockopts = sockopts
+        self._write_buffer_limits = write_buffer_limits
+        self._metrics = metrics
+        self._recorder = recorder
+        self._response_limits = response_limits
         self._reconnecting = False
+        self._connected_before = False
         self._protocol = None
+        self._standby_enabled = standby
+        self._standby_server = standby_server or server
+        self._standby_port = standby_port or port
+        self._standby = None
+        self._standby_connected_before = False
+        self._standby_task = None
+        self._standby_event = asyncio.Event()
+        self._nowait = _NowaitInserts(
+            self.insert,
+            nowait_window,
+            on_insert_error,
+            DEFAULT_NOWAIT_ERRORS)
 
-    async def _connect(self, timeout):
+    async def _create_protocol(self, host, port, timeout, reconnect=False):
         client = self._loop.create_connection(
             lambda: _SiriDBConnProtocol(
                 self._username,
                 self._password,
                 self._dbname),
-            host=self._server,
-            port=self._port)
-        _transport, self._protocol = \
+            host=host,
+            port=port)
+        _transport, protocol = \
             await asyncio.wait_for(client, timeout=timeout)
+        _setup_transport(_transport, self._sockopts, self._write_buffer_limits)
+        _setup_protocol(
+            protocol,
+            host,
+            port,
+            self._metrics,
+            self._recorder,
+            self._response_limits)
 
         try:
             _res = await asyncio.wait_for(
-                self._protocol.auth_future,
+                protocol.auth_future,
                 timeout=timeout)
         except Exception as exc:
             _transport.close()
             raise exc
+        else:
+            _on_connected(protocol, reconnect)
+        return protocol
+
+    async def _connect(self, timeout):
+        self._protocol = await self._create_protocol(
+            self._server,
+            self._port,
+            timeout,
+            self._connected_before)
+        self._connected_before = True
+
+    def _failover(self):
+        '''Swap to the standby connection, returns True when swapped.'''
+        standby = self._standby
+        if standby is None or not standby._connected:
+            return False
+        protocol = self._protocol
+        if protocol and protocol._connected:
+            # make sure the `old` connection will be dropped
+            self._loop.call_later(10.0, protocol.transport.close)
+        logging.info('Failover to the standby connection')
+        self._protocol = standby
+        self._standby = None
+        # the standby server is now the active server, a new standby is
+        # connected to the server which was lost
+        self._server, self._standby_server = \
+            self._standby_server, self._server
+        self._port, self._standby_port = self._standby_port, self._port
+        self._standby_event.set()  # rebuild the standby connection
+        return True
+
+    async def _standby_loop(self):
+        wait_time = 1
+        while True:
+            host, port = self._standby_server, self._standby_port
+            if self._standby is None or not self._standby._connected:
+                try:
+                    self._standby = await self._create_protocol(
+                        host,
+                        port,
+                        timeout=self.MAX_RECONNECT_TIMEOUT,
+                        reconnect=self._standby_connected_before)
+                    self._standby_connected_before = True
+                    self._standby.lost_callback = self._on_standby_lost
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.error(
+                        f'Connecting standby to {host}:{port} failed: '
+                        f'{e}({e.__class__.__name__}), '
+                        f'Try next connect in {wait_time} seconds'
+                    )
+                    await asyncio.sleep(wait_time)
+                    wait_time *= 2
+                    wait_time = min(wait_time, self.MAX_RECONNECT_WAIT_TIME)
+                    continue
+                wait_time = 1
+
+            self._standby_event.clear()
+            try:
+                await asyncio.wait_for(
+                    self._standby_event.wait(),
+                    timeout=self.STANDBY_PING_INTERVAL)
+            except asyncio.TimeoutError:
+                # keep the standby connection warm
+                standby = self._standby
+                if standby is None or not standby._connected:
+                    continue
+                try:
+                    await standby.send_package(CPROTO_REQ_PING, timeout=15)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.error(f'Standby keep-alive failed: {e!r}')
+                    standby.transport.close()
+                    if self._standby is standby:
+                        self._standby = None
+
+    def _on_standby_lost(self, protocol):
+        # a standby which is used after a failover is the active connection
+        if self._standby is protocol:
+            logging.info('Standby connection is lost')
+            self._standby = None
+            self._standby_event.set()
+
+    def _ensure_standby(self):
+        if self._standby_enabled and self._standby_task is None:
+            self._standby_task = \
+                asyncio.ensure_future(self._standby_loop())
 
     async def _reconnect_loop(self):
         try:
@@ -374,6 +1378,9 @@ class SiriDBConn:
             timeout = 2
             protocol = self._protocol
             while True:
+                if self._protocol is not protocol and self.is_connected():
+                    # swapped to the standby connection in the meantime
+                    break
                 host, port = self._server, self._port
                 try:
                     await self._connect(timeout=timeout)
@@ -397,6 +1404,8 @@ class SiriDBConn:
             self._reconnecting = False
 
     def _reconnect(self):
+        if self._failover():
+            return asyncio.sleep(0)
         if self._reconnecting:
             return asyncio.sleep(1)
         self._reconnecting = True
@@ -406,13 +1415,47 @@ class SiriDBConn:
         return self._protocol and self._protocol._connected
 
     async def insert(self, data, timeout=300):
+        if self._encoder is not None and not _is_encoded(data):
+            data = await self._encoder.encode(data)
         result = await self._ensure_write(
             CPROTO_REQ_INSERT,
             data=data,
+            is_binary=_is_encoded(data),
             timeout=timeout)
         return result
 
+    def insert_nowait(self, data, timeout=300):
+        '''Insert without waiting for the response.
+
+        Raises asyncio.QueueFull when `nowait_window` inserts are pending.
+        Failures are reported using the `on_insert_error` callback or the
+        `insert_errors` queue. Use flush() to wait for pending inserts.
+        '''
+        self._nowait.insert(data, timeout)
+
+    async def flush(self):
+        '''Wait until all inserts made with insert_nowait() are done.'''
+        await self._nowait.flush()
+
+    @property
+    def insert_errors(self):
+        '''Queue with (exception, data) tuples for failed inserts which are
+        made with insert_nowait(), when no error callback is used.'''
+        return self._nowait.errors
+
+    @property
+    def pending_inserts(self):
+        '''Number of inserts made with insert_nowait() which are pending.'''
+        return len(self._nowait)
+
     def close(self):
+        if self._standby_task is not None:
+            self._standby_task.cancel()
+            self._standby_task = None
+        if self._standby is not None:
+            if self._standby._connected:
+                self._standby.transport.close()
+            self._standby = None
         if self.is_connected():
             if not hasattr(self._protocol, 'close_future'):
                 self._protocol.close_future = self._loop.create_future()
@@ -426,7 +1469,8 @@ class SiriDBConn:
         result = await self._ensure_write(CPROTO_REQ_PING, timeout=timeout)
         return result
 
-    async def query(self, query, time_precision=None, timeout=60):
+    async def query(self, query, time_precision=None, timeout=60,
+                    lazy=False):
         assert isinstance(query, (str, bytes)), \
             'query should be of type str, unicode or bytes'
         assert time_precision in (
@@ -438,12 +1482,14 @@ class SiriDBConn:
         result = await self._ensure_write(
             CPROTO_REQ_QUERY,
             data=(query, time_precision),
-            timeout=timeout)
+            timeout=timeout,
+            lazy=lazy)
         return result
 
     async def _ensure_write(
             self,
-            tipe, data=None, is_binary=False, timeout=None):
+            tipe, data=None, is_binary=False, timeout=None, lazy=False):
+        self._ensure_standby()
         retry = 0
         while True:
             retry += 1
@@ -457,15 +1503,20 @@ class SiriDBConn:
                 continue
 
             try:
-                res = await self._protocol.send_package(
-                    tipe, data, is_binary, timeout)
+                res = await self._protocol.send(
+                    tipe, data, is_binary, timeout, lazy=lazy)
             except (ServerError,
                     PoolError,
                     OSError,
                     asyncio.TimeoutError) as e:
                 if retry > self.MAX_WRITE_RETRY:
                     raise e
-                if retry % self.RECONNECT_ATTEMPT == 0:
+                if self._metrics is not None:
+                    self._metrics.server(
+                        '{}:{}'.format(self._server, self._port)
+                    ).request(tipe).retries += 1
+                if retry % self.RECONNECT_ATTEMPT == 0 or \
+                        not self.is_connected():
                     await self._reconnect()
                 else:
                     await asyncio.sleep(1.0)
@@ -14,6 +14,58 @@ from .constants import NANOSECOND
 from .logging import logger as logging
 
 
+def _is_encoded(data):
+    '''Insert data which is already encoded using encode_insert().'''
+    return isinstance(data, (bytes, bytearray))
+
+
+def _setup_transport(transport, sockopts=None, write_buffer_limits=None):
+    '''Apply socket options and write buffer limits to a transport.
+
+    Socket options must be an iterable with (level, optname, value) tuples,
+    for example: [(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)]. Write
+    buffer limits must be a (high, low) tuple with the water marks used for
+    flow control.
+    '''
+    if sockopts:
+        sock = transport.get_extra_info('socket')
+        for level, optname, value in sockopts:
+            sock.setsockopt(level, optname, value)
+    if write_buffer_limits is not None:
+        high, low = write_buffer_limits
+        transport.set_write_buffer_limits(high=high, low=low)
+
+
+def _setup_protocol(protocol,
+                    host,
+                    port,
+                    metrics=None,
+                    recorder=None,
+                    response_limits=None):
+    '''Enable recording metrics and traffic and set the response limits
+    for a protocol.'''
+    if metrics is not None:
+        protocol._metrics = metrics.server('{}:{}'.format(host, port))
+    if recorder is not None:
+        protocol._recorder = recorder
+        protocol._recorder_id = recorder.register()
+    if response_limits is not None:
+        spill_size, max_size = response_limits
+        assert spill_size is None or spill_size >= 0, \
+            'spill size should be None or a positive integer'
+        assert max_size is None or max_size >= 0, \
+            'max size should be None or a positive integer'
+        protocol._response_limits = response_limits
+
+
+def _on_connected(protocol, reconnect=False):
+    '''Count a connect, `reconnect` must be True when the same connection
+    was connected before.'''
+    if protocol._metrics is not None:
+        protocol._metrics.connects += 1
+        protocol._metrics.reconnects += reconnect
+
+
 class SiriDBConnection():
 
     def __init__(self,
@@ -24,7 +76,12 @@ class SiriDBConnection():
                  port=DEFAULT_CLIENT_PORT,
                  loop=None,
                  timeout=10,
-                 protocol=_SiriDBProtocol):
+                 protocol=_SiriDBProtocol,
+                 sockopts=None,
+                 write_buffer_limits=None,
+                 metrics=None,
+                 recorder=None,
+                 response_limits=None):
         """WARNING: Creates a new asyncio event loop if none is given."""
         self._loop = loop or asyncio.new_event_loop()
         client = self._loop.create_connection(
@@ -33,6 +90,9 @@ class SiriDBConnection():
             port=port)
         self._transport, self._protocol = self._loop.run_until_complete(
             asyncio.wait_for(client, timeout=timeout))
+        _setup_transport(self._transport, sockopts, write_buffer_limits)
+        _setup_protocol(
+            self._protocol, host, port, metrics, recorder, response_limits)
         self._loop.run_until_complete(self._wait_for_auth())
 
     async def _wait_for_auth(self):
@@ -43,26 +103,76 @@ class SiriDBConnection():
             self._transport.close()
             raise exc
         else:
+            _on_connected(self._protocol)
             self._protocol.on_authenticated()
 
     def close(self):
         if hasattr(self, '_protocol') and hasattr(self._protocol, 'transport'):
             self._protocol.transport.close()
 
-    def query(self, query, time_precision=None, timeout=30):
+    def query(self, query, time_precision=None, timeout=30, lazy=False):
         result = self._loop.run_until_complete(
-            self._protocol.send_package(CPROTO_REQ_QUERY,
-                                        data=(query, time_precision),
-                                        timeout=timeout))
+            self._protocol.send(CPROTO_REQ_QUERY,
+                                data=(query, time_precision),
+                                timeout=timeout,
+                                lazy=lazy))
         return result
 
     def insert(self, data, timeout=600):
         result = self._loop.run_until_complete(
-            self._protocol.send_package(CPROTO_REQ_INSERT,
-                                        data=data,
-                                        timeout=timeout))
+            self._protocol.send(CPROTO_REQ_INSERT,
+                                data=data,
+                                is_binary=_is_encoded(data),
+                                timeout=timeout))
+        return result
+
+    def query_many(self, queries, time_precision=None, timeout=30,
+                   concurrency=None):
+        '''Pipeline multiple queries in a single loop run.
+
+        Returns a list with results in the same order as the given queries.
+        When a query fails, the exception is returned in place of the result.
+        Optionally, concurrency limits the number of pending requests.
+        '''
+        result = self._loop.run_until_complete(
+            self._send_many(
+                CPROTO_REQ_QUERY,
+                [((query, time_precision), False) for query in queries],
+                timeout,
+                concurrency))
+        return result
+
+    def insert_many(self, payloads, timeout=600, concurrency=None):
+        '''Pipeline multiple inserts in a single loop run.
+
+        Returns a list with results in the same order as the given payloads.
+        When an insert fails, the exception is returned in place of the
+        result. Optionally, concurrency limits the number of pending requests.
+        '''
+        result = self._loop.run_until_complete(
+            self._send_many(
+                CPROTO_REQ_INSERT,
+                [(data, _is_encoded(data)) for data in payloads],
+                timeout,
+                concurrency))
         return result
 
+    async def _send_many(self, tipe, items, timeout, concurrency):
+        semaphore = None if concurrency is None else \
+            asyncio.Semaphore(concurrency)
+
+        async def send(data, is_binary):
+            if semaphore is None:
+                return await self._protocol.send(
+                    tipe, data, is_binary, timeout)
+            async with semaphore:
+                return await self._protocol.send(
+                    tipe, data, is_binary, timeout)
+
+        return await asyncio.gather(
+            *(send(data, is_binary) for data, is_binary in items),
+            return_exceptions=True)
+
     def _register_server(self, server, timeout=30):
         '''Register a new SiriDB Server.
 
@@ -95,6 +205,7 @@ class SiriDBAsyncConnection():
 
     _protocol = None
     _keepalive = None
+    _connected_before = False
 
     async def keepalive_loop(self, interval=45):
         sleep = interval
@@ -125,7 +236,12 @@ class SiriDBAsyncConnection():
                       loop=None,
                       timeout=10,
                       keepalive=False,
-                      protocol=_SiriDBProtocol):
+                      protocol=_SiriDBProtocol,
+                      sockopts=None,
+                      write_buffer_limits=None,
+                      metrics=None,
+                      recorder=None,
+                      response_limits=None):
         loop = loop or asyncio.get_running_loop()
         client = loop.create_connection(
             lambda: protocol(username, password, dbname),
@@ -134,6 +250,9 @@ class SiriDBAsyncConnection():
         self._timeout = timeout
         _transport, self._protocol = \
             await asyncio.wait_for(client, timeout=timeout)
+        _setup_transport(_transport, sockopts, write_buffer_limits)
+        _setup_protocol(
+            self._protocol, host, port, metrics, recorder, response_limits)
 
         try:
             _res = await self._protocol.auth_future
@@ -142,6 +261,8 @@ class SiriDBAsyncConnection():
             _transport.close()
             raise exc
         else:
+            _on_connected(self._protocol, self._connected_before)
+            self._connected_before = True
             self._protocol.on_authenticated()
 
         self._last_resp = time.time()
@@ -156,25 +277,34 @@ class SiriDBAsyncConnection():
             self._protocol.transport.close()
             del self._protocol
 
-    async def query(self, query, time_precision=None, timeout=3600):
+    async def query(self,
+                    query,
+                    time_precision=None,
+                    timeout=3600,
+                    priority=None,
+                    lazy=False):
         assert time_precision in (
             None,
             SECOND,
             MICROSECOND,
             MILLISECOND,
             NANOSECOND), 'time_precision must be either None, 0, 1, 2, 3'
-        result = await self._protocol.send_package(
+        result = await self._protocol.send(
             CPROTO_REQ_QUERY,
             data=(query, time_precision),
-            timeout=timeout)
+            timeout=timeout,
+            priority=priority,
+            lazy=lazy)
         self._last_resp = time.time()
         return result
 
-    async def insert(self, data, timeout=3600):
-        result = await self._protocol.send_package(
+    async def insert(self, data, timeout=3600, priority=None):
+        result = await self._protocol.send(
             CPROTO_REQ_INSERT,
             data=data,
-            timeout=timeout)
+            is_binary=_is_encoded(data),
+            timeout=timeout,
+            priority=priority)
         self._last_resp = time.time()
         return result
 
@@ -2,3 +2,8 @@ SECOND = 0
 MILLISECOND = 1
 MICROSECOND = 2
 NANOSECOND = 3
+
+# request priorities, interactive requests are written before bulk requests
+# when they have to wait for the transport
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
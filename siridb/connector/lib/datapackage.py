@@ -8,6 +8,7 @@ This class is used for unpacking a received data package.
 import struct
 import qpack
 from . import protomap
+from .lazy import LazyResult
 
 
 class DataPackage(object):
@@ -28,9 +29,23 @@ class DataPackage(object):
         self.length += self.__class__.struct_datapackage.size
         self.data = None
 
-    def extract_data_from(self, barray):
+    @property
+    def is_valid(self):
+        '''Returns True when the check bit matches the package type.'''
+        return self.tipe ^ 255 == self.checkbit
+
+    def extract_data_from(self, barray, lazy=False):
+        '''Set data and remove the package from the buffer.
+
+        When `lazy` is True, a query result is returned as LazyResult.
+        '''
         try:
-            self.data = self.__class__._MAP[protomap.MAP_RES_DTYPE[self.tipe]](
-                barray[self.__class__.struct_datapackage.size:self.length])
+            data = barray[self.__class__.struct_datapackage.size:self.length]
+            if lazy and self.tipe == protomap.CPROTO_RES_QUERY:
+                self.data = LazyResult(bytes(data))
+            else:
+                self.data = \
+                    self.__class__._MAP[protomap.MAP_RES_DTYPE[self.tipe]](
+                        data)
         finally:
             del barray[:self.length]
@@ -20,6 +20,10 @@ class PoolError(Exception):
     pass
 
 
+class PackageError(Exception):
+    pass
+
+
 class AuthenticationError(Exception):
     pass
 
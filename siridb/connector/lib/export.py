@@ -0,0 +1,310 @@
+'''Bulk export to a columnar binary format.
+
+Series are listed in pages and the points of each series are queried in
+chunks of time, so an export runs in constant memory. Each series is
+written to a separate file which can be memory-mapped for reading.
+
+Directory layout:
+
+    index.json      {"series": {name: {"file", "type", "count", "start",
+                    "end"}}}
+    <n>.sdbcol      one file for each series
+
+File layout (little-endian):
+
+    header:     magic (8 bytes), value type (uint8), padding (7 bytes),
+                number of points (uint64)
+    timestamps: number of points x int64
+    values:     number of points x int64 (integer) or float64 (float),
+                or for string values, (number of points + 1) x uint64
+                offsets followed by the UTF-8 encoded strings
+
+Usage as script:
+
+    python -m siridb.connector.lib.export ./export --port 9000
+
+:copyright: 2022, Jeroen van der Heijden (Cesbit.com)
+'''
+import argparse
+import array
+import asyncio
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from .client import _quote
+from .logging import logger as logging
+
+
+MAGIC = b'SDBCOL01'
+
+TYPE_INTEGER = 0
+TYPE_FLOAT = 1
+TYPE_STRING = 2
+
+# number of points which are requested per chunk (based on the average
+# number of points per time unit of a series)
+DEFAULT_CHUNK_POINTS = 100000
+
+_TYPES = {
+    'integer': TYPE_INTEGER,
+    'float': TYPE_FLOAT,
+    'string': TYPE_STRING,
+}
+
+_struct_header = struct.Struct('<8sB7xQ')
+
+
+def _tofile(arr, fp):
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    arr.tofile(fp)
+
+
+class _SeriesWriter:
+    '''Write the points of a series, in order, to a file.
+
+    Timestamps are written to the file directly while values (and string
+    data) are written to temporary files which are appended on close().
+    '''
+
+    def __init__(self, path, tp):
+        self._fp = open(path, 'wb')
+        self._values = tempfile.TemporaryFile()
+        self._strings = tempfile.TemporaryFile() \
+            if tp == TYPE_STRING else None
+        self._tp = tp
+        self._offset = 0
+        self.count = 0
+        self._fp.write(_struct_header.pack(MAGIC, tp, 0))
+        if self._strings is not None:
+            _tofile(array.array('Q', (0,)), self._values)
+
+    def append(self, points):
+        if not points:
+            return
+        _tofile(array.array('q', (ts for ts, _ in points)), self._fp)
+        if self._tp == TYPE_STRING:
+            offsets = array.array('Q')
+            for _, value in points:
+                data = value.encode('utf-8')
+                self._strings.write(data)
+                self._offset += len(data)
+                offsets.append(self._offset)
+            _tofile(offsets, self._values)
+        else:
+            _tofile(array.array(
+                'q' if self._tp == TYPE_INTEGER else 'd',
+                (value for _, value in points)), self._values)
+        self.count += len(points)
+
+    def close(self):
+        for fp in (self._values, self._strings):
+            if fp is not None:
+                fp.seek(0)
+                shutil.copyfileobj(fp, self._fp)
+                fp.close()
+        self._fp.seek(0)
+        self._fp.write(_struct_header.pack(MAGIC, self._tp, self.count))
+        self._fp.close()
+
+
+async def export(client,
+                 path,
+                 where=None,
+                 chunk_points=DEFAULT_CHUNK_POINTS,
+                 concurrency=4,
+                 page_size=1000,
+                 timeout=60):
+    '''Export series to a directory using a SiriDBClient.
+
+    Series are listed using iter_list() with an optional `where` expression,
+    for example `'name ~ /cpu.*/'`, and are queried using iter_query_range()
+    in chunks of about `chunk_points` points. Returns the index which is
+    also written to index.json.
+    '''
+    os.makedirs(path, exist_ok=True)
+    index = {'series': {}}
+    n = 0
+    async for page in client.iter_list(
+            what='series',
+            columns=('name', 'type', 'length', 'start', 'end'),
+            where=where,
+            page_size=page_size,
+            timeout=timeout):
+        for name, tp, length, start, end in page:
+            fn = '{}.sdbcol'.format(n)
+            n += 1
+            writer = _SeriesWriter(os.path.join(path, fn), _TYPES[tp])
+            try:
+                if length:
+                    interval = max(
+                        1, (end - start + 1) * chunk_points // length)
+                    async for chunk in client.iter_query_range(
+                            _quote(name),
+                            start,
+                            end + 1,
+                            interval,
+                            concurrency=concurrency,
+                            timeout=timeout):
+                        writer.append(chunk.get(name))
+            finally:
+                writer.close()
+            index['series'][name] = {
+                'file': fn,
+                'type': tp,
+                'count': writer.count,
+                'start': start,
+                'end': end,
+            }
+            logging.debug('Exported {} point(s) for series {!r}'
+                          .format(writer.count, name))
+
+    with open(os.path.join(path, 'index.json'), 'w') as fp:
+        json.dump(index, fp)
+    return index
+
+
+class _Strings:
+    '''Read-only sequence with the string values of a series.'''
+
+    def __init__(self, offsets, data):
+        self._offsets = offsets
+        self._data = data
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('index out of range')
+        return str(
+            self._data[self._offsets[idx]:self._offsets[idx + 1]], 'utf-8')
+
+
+class SeriesFile:
+    '''A memory-mapped series file.
+
+    The `timestamps` and `values` attributes are memoryview objects (or a
+    read-only sequence for string values) which read directly from the file.
+    Use close(), or use the file as context manager, to release the map.
+    '''
+
+    def __init__(self, path):
+        assert sys.byteorder == 'little', \
+            'memory mapped series files require a little-endian machine'
+        with open(path, 'rb') as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        view = self._view = memoryview(self._mmap)
+        magic, tp, count = _struct_header.unpack_from(view)
+        if magic != MAGIC:
+            view.release()
+            self._mmap.close()
+            raise ValueError('Not a SiriDB series file: {}'.format(path))
+        self.type = tp
+        pos = _struct_header.size
+        self.timestamps = view[pos:pos + count * 8].cast('q')
+        pos += count * 8
+        if tp == TYPE_STRING:
+            offsets = view[pos:pos + (count + 1) * 8].cast('Q')
+            pos += (count + 1) * 8
+            self.values = _Strings(offsets, view[pos:])
+        else:
+            self.values = view[pos:pos + count * 8].cast(
+                'q' if tp == TYPE_INTEGER else 'd')
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._mmap is None:
+            return
+        self.timestamps.release()
+        if isinstance(self.values, _Strings):
+            self.values._offsets.release()
+            self.values._data.release()
+        else:
+            self.values.release()
+        self._view.release()
+        self._mmap.close()
+        self._mmap = None
+
+
+class ExportReader:
+    '''Read a directory which is created using export().'''
+
+    def __init__(self, path):
+        self._path = path
+        with open(os.path.join(path, 'index.json'), 'r') as fp:
+            self.index = json.load(fp)
+
+    @property
+    def series(self):
+        '''List with the names of all exported series.'''
+        return list(self.index['series'])
+
+    def open(self, name):
+        '''Returns a memory-mapped SeriesFile for a series.'''
+        return SeriesFile(
+            os.path.join(self._path, self.index['series'][name]['file']))
+
+
+def main():
+    from .client import SiriDBClient
+
+    parser = argparse.ArgumentParser(
+        description='Export SiriDB series to columnar binary files')
+    parser.add_argument('path')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--user', default='iris')
+    parser.add_argument('--password', default='siri')
+    parser.add_argument('--dbname', default='dbtest')
+    parser.add_argument(
+        '--where',
+        help='only export series matching this where expression')
+    parser.add_argument(
+        '--chunk-points', type=int, default=DEFAULT_CHUNK_POINTS,
+        help='number of points which are requested per query')
+    parser.add_argument('--concurrency', type=int, default=4)
+    args = parser.parse_args()
+
+    async def run():
+        client = SiriDBClient(
+            args.user,
+            args.password,
+            args.dbname,
+            [(args.host, args.port)])
+        await client.connect()
+        try:
+            return await export(
+                client,
+                args.path,
+                where=args.where,
+                chunk_points=args.chunk_points,
+                concurrency=args.concurrency)
+        finally:
+            client.close()
+
+    index = asyncio.run(run())
+    print('Exported {} series ({} points) to {}'.format(
+        len(index['series']),
+        sum(series['count'] for series in index['series'].values()),
+        args.path))
+
+
+if __name__ == '__main__':
+    main()
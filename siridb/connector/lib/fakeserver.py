@@ -0,0 +1,556 @@
+'''Fake SiriDB Server.
+
+In-process stand-in for a SiriDB server which speaks the client protocol.
+It can be used for tests and benchmarks without a running SiriDB cluster.
+
+Only a small subset of the query language is supported:
+
+    select * from "a", "b", /regex/ [between x and y | after x | before y]
+    (x and y can be a timestamp or now - n, using a second time precision)
+    select mean(interval) from ... (and other aggregate functions)
+    select last() from ... (aggregate over the selected range)
+    list series [columns] [where ...] [limit n]
+    count series [where ...]
+    list servers [columns]
+
+Where expressions support the name column with ==, !=, <, <=, >, >= and ~
+compared to a string (or regular expression) joined using `and`. Other
+queries can be handled using a custom query handler.
+
+Usage as script:
+
+    python -m siridb.connector.lib.fakeserver --port 9000
+
+:copyright: 2022, Jeroen van der Heijden (Cesbit.com)
+'''
+import argparse
+import asyncio
+import random
+import re
+import statistics
+import time
+import qpack
+from . import protomap
+from .datapackage import DataPackage
+from .exceptions import QueryError
+from .exceptions import InsertError
+from .logging import logger as logging
+
+
+_SERIES_COLUMNS = ('name', 'length', 'type', 'start', 'end', 'pool')
+
+_SERVER_COLUMNS = ('name', 'address', 'port', 'pool', 'online', 'status')
+
+_TS = r'-?\d+|now(?:\s*-\s*\d+)?'
+
+# qpack types, a map with x items (up to 5) uses _QP_MAP0 + x
+_QP_MAP0 = 0xf3
+_QP_MAP5 = 0xf8
+_QP_OPEN_ARRAY = 0xfc
+_QP_OPEN_MAP = 0xfd
+_QP_CLOSE_MAP = 0xff
+
+_RE_SELECT = re.compile(
+    r'^\s*select\s+(?:\*|(?P<agg>\w+)\s*\(\s*(?P<interval>\d+)?\s*\))'
+    r'\s+from\s+(?P<series>.+?)'
+    r'(?:\s+between\s+(?P<between_a>{ts})\s+and\s+(?P<between_b>{ts})'
+    r'|\s+after\s+(?P<after>{ts})'
+    r'|\s+before\s+(?P<before>{ts}))?\s*$'.format(ts=_TS),
+    re.IGNORECASE | re.DOTALL)
+
+_RE_LIST = re.compile(
+    r'^\s*(?P<what>list|count)\s+(?P<tp>series|servers)'
+    r'(?:\s+(?P<columns>\w+(?:\s*,\s*\w+)*))?'
+    r'(?:\s+where\s+(?P<where>.+?))?'
+    r'(?:\s+limit\s+(?P<limit>\d+))?\s*$',
+    re.IGNORECASE | re.DOTALL)
+
+_RE_SERIES = re.compile(r'\s*(?:"((?:[^"]|"")*)"|/((?:[^/\\]|\\.)*)/)\s*')
+
+_RE_CONDITION = re.compile(
+    r'\s*\(*\s*(\w+)\s*(==|!=|<=|>=|<|>|~)\s*'
+    r'(?:"((?:[^"]|"")*)"|/((?:[^/\\]|\\.)*)/|(-?\d+))\s*\)*\s*')
+
+_AGGREGATES = {
+    'mean': statistics.mean,
+    'median': statistics.median,
+    'median_low': statistics.median_low,
+    'median_high': statistics.median_high,
+    'sum': sum,
+    'min': min,
+    'max': max,
+    'count': len,
+    'first': lambda values: values[0],
+    'last': lambda values: values[-1],
+    'variance': lambda values:
+        statistics.variance(values) if len(values) > 1 else 0,
+    'pvariance': statistics.pvariance,
+    'stddev': lambda values:
+        statistics.stdev(values) if len(values) > 1 else 0,
+}
+
+_OPERATORS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '~': lambda a, b: b.search(a) is not None,
+}
+
+
+def _series_type(points):
+    if points and isinstance(points[0][1], float):
+        return 'float'
+    if points and isinstance(points[0][1], str):
+        return 'string'
+    return 'integer'
+
+
+def _parse_ts(expr):
+    if expr.lower().startswith('now'):
+        offset = expr[3:].replace('-', '').strip()
+        return int(time.time()) - int(offset or 0)
+    return int(expr)
+
+
+def _parse_series(expr):
+    names, regexes, pos = [], [], 0
+    while pos < len(expr):
+        m = _RE_SERIES.match(expr, pos)
+        if m is None:
+            raise QueryError(
+                'Query error at position {}. Expecting a series name or '
+                'regular expression'.format(pos))
+        if m.group(1) is not None:
+            names.append(m.group(1).replace('""', '"'))
+        else:
+            regexes.append(re.compile(m.group(2)))
+        pos = m.end()
+        if pos < len(expr):
+            if expr[pos] not in ',|':
+                raise QueryError(
+                    'Query error at position {}. Expecting , or |'
+                    .format(pos))
+            pos += 1
+    return names, regexes
+
+
+def _parse_where(where):
+    conditions = []
+    for part in re.split(r'\s+and\s+', where.strip(), flags=re.IGNORECASE):
+        m = _RE_CONDITION.fullmatch(part)
+        if m is None:
+            raise QueryError('Unsupported where expression: {}'.format(part))
+        column, op, string, regex, integer = m.groups()
+        if op == '~':
+            if regex is None:
+                raise QueryError('Expecting a regular expression after ~')
+            value = re.compile(regex)
+        elif string is not None:
+            value = string.replace('""', '"')
+        elif integer is not None:
+            value = int(integer)
+        else:
+            raise QueryError('Expecting a string or integer value')
+        conditions.append((column, _OPERATORS[op], value))
+    return conditions
+
+
+def _unpack_insert(data):
+    '''Returns a list with (series, points) tuples, or None when the data is
+    not a map. Like SiriDB, a series may be in the map more than once.'''
+    tp = data[0] if data else None
+    if tp is not None and _QP_MAP0 <= tp <= _QP_MAP5:
+        body = data[1:]
+    elif tp == _QP_OPEN_MAP:
+        body = data[1:-1] if data[-1] == _QP_CLOSE_MAP else data[1:]
+    else:
+        return None
+    # decode the keys and values as an open array to keep all of them
+    items = qpack.unpackb(bytes((_QP_OPEN_ARRAY,)) + body, decode='utf-8')
+    return list(zip(items[::2], items[1::2]))
+
+
+class _FakeServerProtocol(asyncio.Protocol):
+
+    def __init__(self, server):
+        self._server = server
+        self._buffered_data = bytearray()
+        self._authenticated = False
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._server._connections.add(self)
+
+    def connection_lost(self, exc):
+        self._server._connections.discard(self)
+
+    def data_received(self, data):
+        self._buffered_data.extend(data)
+        size = DataPackage.struct_datapackage.size
+        while len(self._buffered_data) >= size:
+            length, pid, tipe, checkbit = \
+                DataPackage.struct_datapackage.unpack_from(
+                    self._buffered_data, offset=0)
+            if len(self._buffered_data) < size + length:
+                break
+            data = bytes(self._buffered_data[size:size + length])
+            del self._buffered_data[:size + length]
+            self._server._count(tipe)
+            if tipe ^ 255 != checkbit:
+                logging.error('Fake server received an invalid checkbit')
+                self.transport.abort()
+                return
+            asyncio.ensure_future(self._handle(pid, tipe, data))
+
+    async def _handle(self, pid, tipe, data):
+        server = self._server
+        await server._resumed.wait()
+        delay = server.latency + random.random() * server.jitter
+        if delay:
+            await asyncio.sleep(delay)
+        await server._resumed.wait()
+
+        error = server._pop_error(tipe)
+        if error is not None:
+            self.send(pid, *error)
+            return
+
+        try:
+            if tipe == protomap.CPROTO_REQ_INSERT:
+                data = _unpack_insert(data)
+            elif protomap.MAP_REQ_DTYPE.get(tipe) == protomap.DTYPE_QPACK:
+                data = qpack.unpackb(data, decode='utf-8')
+            response = self._process(tipe, data)
+        except QueryError as e:
+            response = protomap.CPROTO_ERR_QUERY, {'error_msg': str(e)}
+        except InsertError as e:
+            response = protomap.CPROTO_ERR_INSERT, {'error_msg': str(e)}
+        except Exception as e:
+            logging.exception(e)
+            response = protomap.CPROTO_ERR_MSG, {'error_msg': str(e)}
+
+        self.send(pid, *response)
+
+    def _process(self, tipe, data):
+        server = self._server
+        if tipe == protomap.CPROTO_REQ_INFO:
+            return protomap.CPROTO_RES_INFO, [server.version, [server.dbname]]
+
+        if tipe == protomap.CPROTO_REQ_AUTH:
+            username, password, dbname = data
+            if dbname != server.dbname:
+                return protomap.CPROTO_ERR_AUTH_UNKNOWN_DB, None
+            if server.users.get(username) != password:
+                return protomap.CPROTO_ERR_AUTH_CREDENTIALS, None
+            self._authenticated = True
+            return protomap.CPROTO_RES_AUTH_SUCCESS, None
+
+        if not self._authenticated:
+            return protomap.CPROTO_ERR_NOT_AUTHENTICATED, None
+
+        if tipe == protomap.CPROTO_REQ_PING:
+            return protomap.CPROTO_RES_ACK, None
+
+        if tipe == protomap.CPROTO_REQ_INSERT:
+            return protomap.CPROTO_RES_INSERT, server._insert(data)
+
+        if tipe == protomap.CPROTO_REQ_QUERY:
+            query, time_precision = data
+            return protomap.CPROTO_RES_QUERY, \
+                server._query(query, time_precision)
+
+        return protomap.CPROTO_ERR_MSG, {
+            'error_msg': 'Fake server does not support package type: {}'
+                         .format(protomap.TEXT_REQ_MAP.get(tipe, tipe))}
+
+    def send(self, pid, tipe, data=None):
+        if self.transport is None or self.transport.is_closing():
+            return
+        data = b'' if protomap.MAP_RES_DTYPE.get(tipe) == protomap.DTYPE_NONE \
+            else qpack.packb(data)
+        self.transport.write(DataPackage.struct_datapackage.pack(
+            len(data),
+            pid,
+            tipe,
+            tipe ^ 255) + data)
+
+
+class FakeSiriDBServer:
+    '''In-process stand-in for a SiriDB server.
+
+    Arguments:
+        users: Dictionary with username and password pairs.
+        dbname: Name of the database.
+        version: Version which is returned on an info request.
+        query_handler: Optional function which is called with the query and
+                       time precision for queries which are not supported
+                       by the fake server. The function should return the
+                       result or raise a QueryError.
+
+    Attributes which can be changed at runtime:
+        latency: Seconds to wait before each request is handled.
+        jitter: Maximum random number of seconds added to the latency.
+        series: Dictionary with the series name and a list of points.
+        servers: List with dictionaries returned by `list servers`.
+        stats: Dictionary with the number of received packages per type.
+    '''
+
+    def __init__(self,
+                 users=None,
+                 dbname='dbtest',
+                 version='2.0.51',
+                 query_handler=None):
+        self.users = {'iris': 'siri'} if users is None else users
+        self.dbname = dbname
+        self.version = version
+        self.query_handler = query_handler
+        self.latency = 0.0
+        self.jitter = 0.0
+        self.series = {}
+        self.servers = []
+        self.stats = {}
+        self.host = None
+        self.port = None
+        self._errors = []
+        self._connections = set()
+        self._server = None
+        self._resumed = asyncio.Event()
+        self._resumed.set()
+
+    async def start(self, host='127.0.0.1', port=0):
+        '''Start listening. Returns the port number which is used.'''
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(
+            lambda: _FakeServerProtocol(self),
+            host=host,
+            port=port)
+        self.host = host
+        self.port = self._server.sockets[0].getsockname()[1]
+        if not self.servers:
+            self.servers.append({
+                'name': '{}:{}'.format(host, self.port),
+                'address': host,
+                'port': self.port,
+                'pool': 0,
+                'online': True,
+                'status': 'running'})
+        return self.port
+
+    def close(self):
+        '''Stop listening and close all client connections.'''
+        if self._server is not None:
+            self._server.close()
+        self.disconnect()
+
+    async def wait_closed(self):
+        if self._server is not None:
+            await self._server.wait_closed()
+            self._server = None
+
+    def disconnect(self):
+        '''Drop all client connections.'''
+        for protocol in list(self._connections):
+            protocol.transport.abort()
+
+    def pause(self):
+        '''Stop handling requests until resume() is called.'''
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    def inject_error(self,
+                     tipe=protomap.CPROTO_ERR_SERVER,
+                     error_msg='Injected error',
+                     request=None,
+                     count=1):
+        '''Respond to the next `count` requests with an error.
+
+        The error is a response type from protomap, for example
+        CPROTO_ERR_POOL. When `request` is given, only requests of this
+        type (for example CPROTO_REQ_QUERY) receive the error.
+        '''
+        data = {'error_msg': error_msg} \
+            if protomap.MAP_RES_DTYPE.get(tipe) == protomap.DTYPE_QPACK \
+            else None
+        self._errors.append([request, tipe, data, count])
+
+    def _pop_error(self, request):
+        for error in self._errors:
+            if error[0] is None and request == protomap.CPROTO_REQ_AUTH:
+                continue
+            if error[0] is None or error[0] == request:
+                error[3] -= 1
+                if error[3] <= 0:
+                    self._errors.remove(error)
+                return error[1], error[2]
+
+    def _count(self, tipe):
+        name = protomap.TEXT_REQ_MAP.get(tipe, 'UNKNOWN')
+        self.stats[name] = self.stats.get(name, 0) + 1
+
+    def _insert(self, data):
+        if data is None:
+            raise InsertError('Expecting a map with series and points')
+        # like SiriDB, an insert is validated before any point is inserted
+        for name, points in data:
+            if not isinstance(points, list) or not all(
+                    isinstance(point, list) and len(point) == 2 and
+                    isinstance(point[0], int) for point in points):
+                raise InsertError(
+                    'Invalid points for series: {!r}'.format(name))
+        n = 0
+        for name, points in data:
+            self.series.setdefault(name, []).extend(points)
+            n += len(points)
+        for name, _points in data:
+            self.series[name].sort(key=lambda point: point[0])
+        return {'success_msg': 'Successfully inserted {} point(s).'
+                               .format(n)}
+
+    def _query(self, query, time_precision):
+        if isinstance(query, bytes):
+            query = query.decode('utf-8')
+
+        m = _RE_SELECT.match(query)
+        if m is not None:
+            return self._select(m)
+
+        m = _RE_LIST.match(query)
+        if m is not None:
+            return self._list(m)
+
+        if self.query_handler is not None:
+            return self.query_handler(query, time_precision)
+
+        raise QueryError(
+            'Query is not supported by the fake server: {}'.format(query))
+
+    def _select(self, m):
+        names, regexes = _parse_series(m.group('series'))
+        for name in names:
+            if name not in self.series:
+                raise QueryError('Cannot find series: "{}"'.format(name))
+        for regex in regexes:
+            names.extend(
+                name for name in self.series if regex.search(name))
+
+        start, end = None, None
+        if m.group('between_a') is not None:
+            start = _parse_ts(m.group('between_a'))
+            end = _parse_ts(m.group('between_b'))
+        elif m.group('after') is not None:
+            start = _parse_ts(m.group('after'))
+        elif m.group('before') is not None:
+            end = _parse_ts(m.group('before'))
+
+        result = {
+            name: [
+                point for point in self.series[name]
+                if (start is None or point[0] >= start) and
+                (end is None or point[0] < end)]
+            for name in names}
+
+        agg = m.group('agg')
+        if agg is None:
+            return result
+        try:
+            func = _AGGREGATES[agg.lower()]
+        except KeyError:
+            raise QueryError('Unknown aggregate function: {}'.format(agg))
+        if m.group('interval') is None:
+            # like SiriDB, the timestamp of the last point is used, or of the
+            # first point for first()
+            index = 0 if agg.lower() == 'first' else -1
+            return {
+                name: [[points[index][0], func([v for _, v in points])]]
+                if points else []
+                for name, points in result.items()}
+        interval = int(m.group('interval'))
+        if interval <= 0:
+            raise QueryError('Group by time must be an integer value larger '
+                             'than zero')
+        for name, points in result.items():
+            # like SiriDB, points are grouped by the end of each interval
+            buckets = {}
+            for ts, value in points:
+                buckets.setdefault(-(-ts // interval) * interval, []) \
+                    .append(value)
+            result[name] = [
+                [ts, func(values)] for ts, values in buckets.items()]
+        return result
+
+    def _list(self, m):
+        tp = m.group('tp').lower()
+        if tp == 'series':
+            rows = [
+                {
+                    'name': name,
+                    'length': len(points),
+                    'type': _series_type(points),
+                    'start': points[0][0] if points else None,
+                    'end': points[-1][0] if points else None,
+                    'pool': 0
+                }
+                for name, points in self.series.items()]
+            available = _SERIES_COLUMNS
+        else:
+            rows = self.servers
+            available = _SERVER_COLUMNS
+
+        if m.group('where'):
+            for column, op, value in _parse_where(m.group('where')):
+                if column not in available:
+                    raise QueryError('Unknown column: {}'.format(column))
+                rows = [row for row in rows if op(row[column], value)]
+
+        if m.group('limit'):
+            rows = rows[:int(m.group('limit'))]
+
+        if m.group('what').lower() == 'count':
+            return {tp: len(rows)}
+
+        columns = [c.strip() for c in m.group('columns').split(',')] \
+            if m.group('columns') else ['name']
+        for column in columns:
+            if column not in available:
+                raise QueryError('Unknown column: {}'.format(column))
+        return {
+            'columns': columns,
+            tp: [[row[column] for column in columns] for row in rows]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake SiriDB Server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--user', default='iris')
+    parser.add_argument('--password', default='siri')
+    parser.add_argument('--dbname', default='dbtest')
+    parser.add_argument(
+        '--latency', type=float, default=0.0,
+        help='seconds to wait before each request is handled')
+    args = parser.parse_args()
+
+    async def serve():
+        server = FakeSiriDBServer(
+            users={args.user: args.password},
+            dbname=args.dbname)
+        server.latency = args.latency
+        port = await server.start(args.host, args.port)
+        print('Fake SiriDB server listening on {}:{}'.format(args.host, port),
+              flush=True)
+        await server._server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,376 @@
+'''Bulk import of CSV and line protocol files.
+
+Files are read in chunks which are parsed in worker processes. The points
+of a chunk are grouped per series and encoded into packages of about a
+given number of bytes. Packages are inserted over multiple connections at
+the same time using a SiriDBClient.
+
+Supported formats:
+
+    csv     series,timestamp,value (a header line is skipped)
+    line    measurement[,tag=value...] field=value[,field=value...] timestamp
+            each field is inserted as series `measurement[,tags].field`,
+            integer values must have an `i` suffix
+
+Timestamps are used as-is so they must match the time precision of the
+database. The byte offset of the last completely inserted chunk can be
+stored in a checkpoint file which is used to resume an import.
+
+Usage:
+
+    siridb-import data.csv --servers localhost:9000 --checkpoint data.ckpt
+
+:copyright: 2022, Jeroen van der Heijden (Cesbit.com)
+'''
+import argparse
+import asyncio
+import collections
+import csv
+import io
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import qpack
+from .protocol import encode_insert
+
+
+# number of bytes which are read and parsed at once by a worker
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+# size in bytes of a single insert package
+DEFAULT_PACKAGE_BYTES = 256 * 1024
+
+# number of points per series which are encoded to estimate the size of a
+# point
+_SAMPLE_POINTS = 100
+
+# number of insert packages which are sent at the same time
+DEFAULT_CONCURRENCY = 8
+
+
+def _value(s):
+    try:
+        return int(s)
+    except ValueError:
+        pass
+    try:
+        return float(s)
+    except ValueError:
+        return s
+
+
+def _parse_csv(text, series):
+    errors = 0
+    for row in csv.reader(io.StringIO(text)):
+        if not row:
+            continue
+        try:
+            name, ts, value = row
+            series[name].append([int(ts), _value(value)])
+        except ValueError:
+            errors += 1
+    return errors
+
+
+def _split(s, sep):
+    '''Split on `sep` outside double quotes and not escaped.'''
+    parts, start, quoted, escaped = [], 0, False, False
+    for i, c in enumerate(s):
+        if escaped:
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif c == '"':
+            quoted = not quoted
+        elif c == sep and not quoted:
+            parts.append(s[start:i])
+            start = i + 1
+    parts.append(s[start:])
+    return parts
+
+
+def _line_value(s):
+    if s.startswith('"'):
+        return s[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    if s.endswith(('i', 'u')):
+        return int(s[:-1])
+    if s in ('t', 'T', 'true', 'True', 'TRUE'):
+        return 1
+    if s in ('f', 'F', 'false', 'False', 'FALSE'):
+        return 0
+    return float(s)
+
+
+def _parse_line(text, series):
+    errors = 0
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            key, fields, ts = _split(line, ' ')
+            ts = int(ts)
+            for field in _split(fields, ','):
+                name, value = field.split('=', 1)
+                series['{}.{}'.format(key, name)].append(
+                    [ts, _line_value(value)])
+        except ValueError:
+            errors += 1
+    return errors
+
+
+_PARSERS = {
+    'csv': _parse_csv,
+    'line': _parse_line,
+}
+
+
+def _parse_chunk(fmt, data, package_bytes):
+    '''Parse a chunk and returns (packages, number of points, errors).
+
+    The size of a package is estimated using the encoded size of the first
+    points of each series, so a package is about `package_bytes` bytes. A
+    package contains at least one point.
+
+    This function runs in a worker process.
+    '''
+    series = collections.defaultdict(list)
+    errors = _PARSERS[fmt](data.decode('utf-8'), series)
+
+    packages, package, size, n = [], {}, 0, 0
+    for name, points in series.items():
+        points.sort(key=lambda point: point[0])
+        n += len(points)
+        sample = points[:_SAMPLE_POINTS]
+        point_size = len(qpack.packb(sample)) / len(sample)
+        name_size = len(qpack.packb(name))
+        while points:
+            room = int((package_bytes - size - name_size) // point_size)
+            if room < 1 and package:
+                packages.append(encode_insert(package))
+                package, size = {}, 0
+                continue
+            room = max(room, 1)
+            package[name], points = points[:room], points[room:]
+            size += name_size + len(package[name]) * point_size
+            if points:
+                packages.append(encode_insert(package))
+                package, size = {}, 0
+    if package:
+        packages.append(encode_insert(package))
+    return packages, n, errors
+
+
+def _read_chunks(fp, chunk_size):
+    '''Yields (end offset, data) tuples, each ending at a new line.'''
+    while True:
+        data = fp.read(chunk_size)
+        if not data:
+            break
+        if not data.endswith(b'\n'):
+            data += fp.readline()
+        yield fp.tell(), data
+
+
+def _write_checkpoint(path, offset):
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as fp:
+        fp.write(str(offset))
+    os.replace(tmp, path)
+
+
+def _read_checkpoint(path):
+    try:
+        with open(path, 'r') as fp:
+            return int(fp.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+class _Progress:
+
+    def __init__(self, total, offset, out=sys.stderr):
+        self._total = total
+        self._start_offset = offset
+        self._start = self._last = time.monotonic()
+        self._out = out
+        self.offset = offset
+        self.points = 0
+        self.errors = 0
+
+    def show(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last < 1.0:
+            return
+        self._last = now
+        elapsed = max(now - self._start, 1e-9)
+        self._out.write(
+            '\r{:6.1%}  {:,} points  {:,.0f} points/s  {:.1f} MB/s  '
+            '{:,} errors'.format(
+                self.offset / self._total if self._total else 1.0,
+                self.points,
+                self.points / elapsed,
+                (self.offset - self._start_offset) / elapsed / 1e6,
+                self.errors))
+        self._out.flush()
+
+
+async def import_file(client,
+                      path,
+                      fmt='csv',
+                      executor=None,
+                      chunk_size=DEFAULT_CHUNK_SIZE,
+                      package_bytes=DEFAULT_PACKAGE_BYTES,
+                      concurrency=DEFAULT_CONCURRENCY,
+                      checkpoint=None,
+                      progress=None,
+                      timeout=300):
+    '''Import a CSV or line protocol file using a SiriDBClient.
+
+    Chunks are parsed using `executor` (the default executor of the event
+    loop when None, which is a thread pool) into packages of about
+    `package_bytes` bytes, and inserted with at most `concurrency` packages
+    at the same time. When `checkpoint` is a file name, the import starts
+    at the offset stored in this file, and the offset is updated after each
+    inserted chunk. Returns a (points, errors) tuple.
+    '''
+    assert fmt in _PARSERS, \
+        'fmt should be one of: {}'.format(', '.join(_PARSERS))
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    offset = 0 if checkpoint is None else _read_checkpoint(checkpoint)
+    points, errors = 0, 0
+
+    # chunks which are parsed or inserted, in file order
+    pending = collections.deque()
+
+    async def insert(package):
+        try:
+            return await client.insert(package, timeout=timeout)
+        finally:
+            semaphore.release()
+
+    async def handle(parse):
+        nonlocal points, errors
+        packages, n, e = await parse
+        tasks = []
+        for package in packages:
+            await semaphore.acquire()
+            tasks.append(asyncio.ensure_future(insert(package)))
+        await asyncio.gather(*tasks)
+        points += n
+        errors += e
+        if progress is not None:
+            progress.points, progress.errors = points, errors
+
+    async def complete(wait_all=False):
+        while pending and (wait_all or pending[0][1].done() or
+                           len(pending) > concurrency):
+            end, task = pending.popleft()
+            await task
+            if checkpoint is not None:
+                _write_checkpoint(checkpoint, end)
+            if progress is not None:
+                progress.offset = end
+                progress.show()
+
+    with open(path, 'rb') as fp:
+        fp.seek(offset)
+        if offset == 0 and fmt == 'csv':
+            header = fp.readline()
+            if _parse_csv(header.decode('utf-8'), collections.defaultdict(
+                    list)) == 0:
+                fp.seek(0)  # the first line is not a header
+        try:
+            for end, data in _read_chunks(fp, chunk_size):
+                parse = loop.run_in_executor(
+                    executor, _parse_chunk, fmt, data, package_bytes)
+                pending.append((end, asyncio.ensure_future(handle(parse))))
+                await complete()
+            await complete(wait_all=True)
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    if progress is not None:
+        progress.show(force=True)
+    return points, errors
+
+
+def main():
+    from .client import SiriDBClient
+
+    parser = argparse.ArgumentParser(
+        description='Import CSV or line protocol files into SiriDB')
+    parser.add_argument('file')
+    parser.add_argument(
+        '--format', choices=sorted(_PARSERS), default=None,
+        help='file format (default: based on the file extension)')
+    parser.add_argument(
+        '--servers', default='127.0.0.1:9000',
+        help='comma separated list with host:port (default: %(default)s)')
+    parser.add_argument(
+        '--connections', type=int, default=2,
+        help='number of connections per server (default: %(default)s)')
+    parser.add_argument('--user', default='iris')
+    parser.add_argument('--password', default='siri')
+    parser.add_argument('--dbname', default='dbtest')
+    parser.add_argument(
+        '--workers', type=int, default=os.cpu_count(),
+        help='number of parser processes (default: %(default)s)')
+    parser.add_argument(
+        '--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+        help='bytes per chunk (default: %(default)s)')
+    parser.add_argument(
+        '--package-bytes', type=int, default=DEFAULT_PACKAGE_BYTES,
+        help='approximate bytes per insert (default: %(default)s)')
+    parser.add_argument(
+        '--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+        help='inserts sent at the same time (default: %(default)s)')
+    parser.add_argument(
+        '--checkpoint',
+        help='file used to store the offset and resume an import')
+    args = parser.parse_args()
+
+    fmt = args.format or (
+        'csv' if args.file.lower().endswith('.csv') else 'line')
+
+    hostlist = []
+    for server in args.servers.split(','):
+        host, _, port = server.strip().rpartition(':')
+        hostlist.extend([(host, int(port))] * args.connections)
+
+    async def run():
+        client = SiriDBClient(
+            args.user,
+            args.password,
+            args.dbname,
+            hostlist)
+        await client.connect()
+        progress = _Progress(
+            os.path.getsize(args.file),
+            0 if args.checkpoint is None else
+            _read_checkpoint(args.checkpoint))
+        try:
+            with ProcessPoolExecutor(args.workers) as executor:
+                return await import_file(
+                    client,
+                    args.file,
+                    fmt=fmt,
+                    executor=executor,
+                    chunk_size=args.chunk_size,
+                    package_bytes=args.package_bytes,
+                    concurrency=args.concurrency,
+                    checkpoint=args.checkpoint,
+                    progress=progress)
+        finally:
+            client.close()
+
+    points, errors = asyncio.run(run())
+    print('\nImported {:,} points ({:,} invalid lines)'.format(
+        points, errors))
+
+
+if __name__ == '__main__':
+    main()
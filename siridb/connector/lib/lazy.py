@@ -0,0 +1,176 @@
+'''Lazy query results.
+
+A LazyResult keeps the raw qpack payload of a response and only decodes
+the value of a key when it is accessed. The keys and the offsets of their
+values are read in one pass over the payload, without decoding the values.
+
+:copyright: 2022, Jeroen van der Heijden (Cesbit.com)
+'''
+import collections.abc
+import mmap
+import struct
+import qpack
+
+
+_QP_RAW8, _QP_RAW64 = 0xe4, 0xe7
+_QP_ARRAY0, _QP_ARRAY2, _QP_ARRAY5 = 0xed, 0xef, 0xf2
+_QP_MAP0, _QP_MAP5 = 0xf3, 0xf8
+_QP_OPEN_ARRAY, _QP_OPEN_MAP = 0xfc, 0xfd
+_QP_CLOSE_ARRAY, _QP_CLOSE_MAP = 0xfe, 0xff
+
+_RAW_SIZE = {
+    0xe4: struct.Struct('<B'),
+    0xe5: struct.Struct('<H'),
+    0xe6: struct.Struct('<I'),
+    0xe7: struct.Struct('<Q'),
+}
+
+
+def _fixed_size(tp):
+    if tp < 0x80:
+        return 1  # small integers, hook and small doubles
+    if tp < _QP_RAW8:
+        return 1 + tp - 0x80  # raw data with the length in the type
+    return {
+        0xe8: 2, 0xe9: 3, 0xea: 5, 0xeb: 9, 0xec: 9,  # int8..64, double
+        0xf9: 1, 0xfa: 1, 0xfb: 1,  # true, false, null
+    }.get(tp, 0)
+
+
+# size in bytes (including the type) for values with a fixed size, 0 for
+# raw data with a length and for containers
+_FIXED_SIZE = tuple(_fixed_size(tp) for tp in range(256))
+
+
+def _skip(qp, pos, end):
+    '''Returns the position after the value which starts at `pos`.'''
+    # remaining values in fixed size containers, -1 for open containers
+    stack = []
+    while pos < end:
+        tp = qp[pos]
+        size = _FIXED_SIZE[tp]
+        if size:
+            pos += size
+        elif tp == _QP_ARRAY2 and _FIXED_SIZE[qp[pos + 1]] and \
+                _FIXED_SIZE[qp[pos + 1 + _FIXED_SIZE[qp[pos + 1]]]]:
+            # fast path for points, an array with a timestamp and value
+            pos += 1 + _FIXED_SIZE[qp[pos + 1]]
+            pos += _FIXED_SIZE[qp[pos]]
+        elif tp <= _QP_RAW64:
+            st = _RAW_SIZE[tp]
+            pos += 1 + st.size + st.unpack_from(qp, pos + 1)[0]
+        elif tp <= _QP_MAP5:
+            n = tp - _QP_ARRAY0 if tp <= _QP_ARRAY5 else 2 * (tp - _QP_MAP0)
+            pos += 1
+            if n:
+                stack.append(n)
+                continue
+        elif tp == _QP_OPEN_ARRAY or tp == _QP_OPEN_MAP:
+            pos += 1
+            stack.append(-1)
+            continue
+        else:
+            pos += 1
+            if not stack or stack[-1] != -1:
+                raise ValueError(
+                    'Unexpected close in qpack at position {}'.format(pos))
+            stack.pop()
+
+        # a value is completed, which might complete its container as well
+        while stack and stack[-1] > 0:
+            stack[-1] -= 1
+            if stack[-1]:
+                break
+            stack.pop()
+        if not stack:
+            return pos
+
+    if any(n != -1 for n in stack):
+        raise ValueError('Incomplete qpack data')
+    # open containers are allowed to end without a close
+    return pos
+
+
+def _index(qp):
+    '''Returns a dictionary with the (start, end) offset of each value.'''
+    end = len(qp)
+    tp = qp[0] if end else None
+    if tp is not None and _QP_MAP0 <= tp <= _QP_MAP5:
+        n, is_open = tp - _QP_MAP0, False
+    elif tp == _QP_OPEN_MAP:
+        n, is_open = None, True
+    else:
+        raise ValueError('Lazy results require a qpack map')
+
+    index = {}
+    pos = 1
+    while pos < end and (n is None or len(index) < n):
+        if is_open and qp[pos] == _QP_CLOSE_MAP:
+            break
+        key_end = _skip(qp, pos, end)
+        key = qpack.unpackb(bytes(qp[pos:key_end]), decode='utf-8')
+        pos = _skip(qp, key_end, end)
+        index[key] = (key_end, pos)
+    return index
+
+
+class LazyResult(collections.abc.Mapping):
+    '''Read-only mapping for a query result which decodes values on access.
+
+    Values are decoded each time they are accessed and are not cached, so
+    keep a reference to a value when it is used more than once. Use
+    release(), or use the result as context manager, to free the payload.
+
+    The payload can be any object which supports the buffer protocol and
+    returns bytes when sliced, for example bytes or a memory map.
+    '''
+
+    def __init__(self, data):
+        self._data = data
+        self._index = _index(data)
+
+    def __getitem__(self, key):
+        if self._data is None:
+            raise ValueError('Lazy result is released')
+        start, end = self._index[key]
+        return qpack.unpackb(bytes(self._data[start:end]), decode='utf-8')
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __repr__(self):
+        return '<LazyResult keys={}>'.format(len(self._index))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    @property
+    def nbytes(self):
+        '''Size of the raw payload in bytes.'''
+        return 0 if self._data is None else len(self._data)
+
+    def raw(self, key):
+        '''Returns the qpack encoded value of a key.'''
+        if self._data is None:
+            raise ValueError('Lazy result is released')
+        start, end = self._index[key]
+        return bytes(self._data[start:end])
+
+    def release(self):
+        '''Free the raw payload, the result cannot be used after this.
+
+        A memory-mapped payload is closed.
+        '''
+        data, self._data = self._data, None
+        self._index = {}
+        if isinstance(data, mmap.mmap):
+            data.close()
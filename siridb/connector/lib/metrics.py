@@ -0,0 +1,215 @@
+'''SiriDB Connector Metrics.
+
+Records latency histograms, bytes, encode and decode time, timeouts,
+retries, reconnects and in-flight requests per server and request type.
+
+:copyright: 2022, Jeroen van der Heijden (Cesbit.com)
+'''
+import bisect
+from . import protomap
+
+
+# upper bounds (in seconds) for the latency histogram buckets
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0)
+
+_PREFIX = 'siridb_connector_'
+
+# name, type, help, attribute
+_REQUEST_COUNTERS = (
+    ('requests_total', 'counter', 'Number of requests sent.', 'requests'),
+    ('errors_total', 'counter', 'Number of error responses.', 'errors'),
+    ('timeouts_total', 'counter', 'Number of timed out requests.',
+     'timeouts'),
+    ('retries_total', 'counter', 'Number of retried requests.', 'retries'),
+    ('bytes_sent_total', 'counter', 'Number of bytes sent.', 'bytes_sent'),
+    ('bytes_received_total', 'counter', 'Number of bytes received.',
+     'bytes_received'),
+    ('encode_seconds_total', 'counter', 'Time spent encoding requests.',
+     'encode_time'),
+    ('decode_seconds_total', 'counter', 'Time spent decoding responses.',
+     'decode_time'),
+    ('in_flight', 'gauge', 'Number of requests waiting for a response.',
+     'in_flight'),
+)
+
+
+def _request_name(tipe):
+    name = protomap.TEXT_REQ_MAP.get(tipe, 'UNKNOWN')
+    return name.replace('CPROTO_REQ_', '').lower()
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+class _Histogram:
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        cumulative, buckets = 0, {}
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            buckets[bound] = cumulative
+        return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+
+class _RequestMetrics:
+
+    __slots__ = (
+        'latency', 'requests', 'errors', 'timeouts', 'retries', 'bytes_sent',
+        'bytes_received', 'encode_time', 'decode_time', 'in_flight')
+
+    def __init__(self, bounds):
+        self.latency = _Histogram(bounds)
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.encode_time = 0.0
+        self.decode_time = 0.0
+        self.in_flight = 0
+
+    def on_sent(self, nbytes, encode_time):
+        self.requests += 1
+        self.bytes_sent += nbytes
+        self.encode_time += encode_time
+        self.in_flight += 1
+
+    def on_received(self, latency, nbytes, decode_time, is_error):
+        self.latency.observe(latency)
+        self.bytes_received += nbytes
+        self.decode_time += decode_time
+        self.errors += is_error
+        self.in_flight -= 1
+
+    def on_timeout(self):
+        self.timeouts += 1
+        self.in_flight -= 1
+
+    def on_lost(self):
+        self.errors += 1
+        self.in_flight -= 1
+
+    def snapshot(self):
+        result = {
+            name: getattr(self, name)
+            for name in self.__slots__ if name != 'latency'}
+        result['latency'] = self.latency.snapshot()
+        return result
+
+
+class _ServerMetrics:
+
+    __slots__ = ('_bounds', '_requests', 'connects', 'reconnects')
+
+    def __init__(self, bounds):
+        self._bounds = bounds
+        self._requests = {}
+        self.connects = 0
+        self.reconnects = 0
+
+    def request(self, tipe):
+        try:
+            return self._requests[tipe]
+        except KeyError:
+            metrics = self._requests[tipe] = _RequestMetrics(self._bounds)
+            return metrics
+
+    def snapshot(self):
+        return {
+            'connects': self.connects,
+            'reconnects': self.reconnects,
+            'requests': {
+                _request_name(tipe): metrics.snapshot()
+                for tipe, metrics in self._requests.items()}
+        }
+
+
+class Metrics:
+    '''Collect metrics for one or more SiriDB connections.
+
+    A Metrics instance can be passed to SiriDBClient, SiriDBConn or to the
+    connect functions using the `metrics` keyword argument. Nothing is
+    recorded when no metrics instance is given.
+
+    Latency is measured from the moment a request is written until the
+    response is received and is stored in a histogram with `buckets` as
+    upper bounds, in seconds.
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._bounds = tuple(sorted(buckets))
+        self._servers = {}
+
+    def server(self, name):
+        '''Returns the metrics for a server, `name` is usually host:port.'''
+        try:
+            return self._servers[name]
+        except KeyError:
+            metrics = self._servers[name] = _ServerMetrics(self._bounds)
+            return metrics
+
+    def snapshot(self):
+        '''Returns a dictionary with all metrics per server.'''
+        return {
+            name: metrics.snapshot()
+            for name, metrics in self._servers.items()}
+
+    def to_prometheus(self):
+        '''Returns all metrics using the Prometheus text format.'''
+        lines = []
+        snapshot = self.snapshot()
+
+        name = _PREFIX + 'reconnects_total'
+        lines.append('# HELP {} Number of reconnects.'.format(name))
+        lines.append('# TYPE {} counter'.format(name))
+        for server, metrics in snapshot.items():
+            lines.append('{}{{server="{}"}} {}'.format(
+                name, _escape(server), metrics['reconnects']))
+
+        for suffix, tp, description, attr in _REQUEST_COUNTERS:
+            name = _PREFIX + suffix
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, tp))
+            for server, metrics in snapshot.items():
+                for request, values in metrics['requests'].items():
+                    lines.append('{}{{server="{}",type="{}"}} {}'.format(
+                        name, _escape(server), request, values[attr]))
+
+        name = _PREFIX + 'request_duration_seconds'
+        lines.append('# HELP {} Request latency.'.format(name))
+        lines.append('# TYPE {} histogram'.format(name))
+        for server, metrics in snapshot.items():
+            for request, values in metrics['requests'].items():
+                labels = 'server="{}",type="{}"'.format(
+                    _escape(server), request)
+                latency = values['latency']
+                for bound, count in latency['buckets'].items():
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                        name, labels, bound, count))
+                lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(
+                    name, labels, latency['count']))
+                lines.append('{}_sum{{{}}} {}'.format(
+                    name, labels, latency['sum']))
+                lines.append('{}_count{{{}}} {}'.format(
+                    name, labels, latency['count']))
+
+        lines.append('')
+        return '\n'.join(lines)
@@ -0,0 +1,165 @@
+'''Multi-loop client.
+
+A MultiLoopClient runs a number of event loops, each in its own thread and
+each with a SiriDBClient which owns a subset of the connections. Requests
+are made on the event loop of the caller and are dispatched to the shard
+with the fewest pending requests, so encoding, framing and decoding for
+different connections run in different threads.
+
+Threads only run at the same time while the GIL is released, for example
+while reading from and writing to sockets. How well a client scales with
+the number of loops depends on the payloads and on the Python build.
+
+:copyright: 2022, Jeroen van der Heijden (Cesbit.com)
+'''
+import asyncio
+import itertools
+import threading
+from .client import SiriDBClient
+from .constants import PRIORITY_INTERACTIVE
+from .constants import PRIORITY_BULK
+
+
+# number of event loops which are used by a MultiLoopClient
+DEFAULT_LOOPS = 4
+
+
+class _Shard:
+
+    def __init__(self, n):
+        self.loop = asyncio.new_event_loop()
+        self.client = None
+        self.pending = 0
+        self._thread = threading.Thread(
+            target=self._run,
+            name='siridb-loop-{}'.format(n),
+            daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.loop.close()
+
+    def run(self, coro):
+        '''Run a coroutine on the shard, returns an asyncio future for the
+        event loop of the caller.'''
+        return asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+
+class MultiLoopClient:
+    '''SiriDBClient with connections sharded over event loops in threads.
+
+    Arguments are the same as for SiriDBClient, except for `loop`. Each of
+    the `loops` shards gets a part of the hostlist: when the hostlist has
+    fewer entries than there are loops, the hostlist is repeated so every
+    shard has at least one connection. Use a hostlist with the same server
+    multiple times for more connections to a server.
+
+    Requests use the same arguments as the SiriDBClient methods. Data and
+    results are passed between threads, so insert data must not be changed
+    while an insert is pending.
+    '''
+
+    def __init__(self,
+                 username,
+                 password,
+                 dbname,
+                 hostlist,
+                 loops=DEFAULT_LOOPS,
+                 **kwargs):
+        assert loops > 0, 'loops should be a positive integer'
+        assert hostlist, 'hostlist should contain at least one server'
+        assert 'loop' not in kwargs, 'loop cannot be used with multiple loops'
+        self._args = (username, password, dbname)
+        self._kwargs = kwargs
+        hostlist = list(hostlist)
+        if len(hostlist) < loops:
+            hostlist = list(itertools.islice(itertools.cycle(hostlist), loops))
+        self._hostlists = [hostlist[n::loops] for n in range(loops)]
+        self._shards = []
+        self._order = 0
+
+    @property
+    def loops(self):
+        return len(self._hostlists)
+
+    @property
+    def connected(self):
+        '''Can be used to check the client has any active connections'''
+        return any(
+            shard.client is not None and shard.client.connected
+            for shard in self._shards)
+
+    async def _create_client(self, hostlist):
+        return SiriDBClient(*self._args, hostlist, **self._kwargs)
+
+    async def connect(self, timeout=None):
+        '''Start the loops and connect, returns the combined result of
+        SiriDBClient.connect() for all shards.'''
+        if not self._shards:
+            shards = [_Shard(n) for n in range(self.loops)]
+            try:
+                for shard, hostlist in zip(shards, self._hostlists):
+                    shard.client = await shard.run(
+                        self._create_client(hostlist))
+            except BaseException:
+                for shard in shards:
+                    shard.stop()
+                raise
+            self._shards = shards
+        results = await asyncio.gather(*(
+            shard.run(shard.client.connect(timeout))
+            for shard in self._shards))
+        # connect() returns None when a client is already connected
+        return [r for result in results for r in result or []]
+
+    async def close(self):
+        '''Close all connections and stop the loops.'''
+        shards, self._shards = self._shards, []
+        for shard in shards:
+            if shard.client is not None:
+                await shard.run(self._close_client(shard.client))
+            shard.stop()
+
+    @staticmethod
+    async def _close_client(client):
+        client.close()
+
+    def _get_shard(self):
+        if not self._shards:
+            raise ConnectionError('Client is not connected')
+        # start with the next shard so ties are shared by all shards
+        self._order = (self._order + 1) % len(self._shards)
+        shards = self._shards[self._order:] + self._shards[:self._order]
+        return min(shards, key=lambda shard: shard.pending)
+
+    async def _dispatch(self, method, *args, **kwargs):
+        shard = self._get_shard()
+        shard.pending += 1
+        try:
+            return await shard.run(
+                getattr(shard.client, method)(*args, **kwargs))
+        finally:
+            shard.pending -= 1
+
+    async def insert(self, data, timeout=300, priority=PRIORITY_BULK):
+        return await self._dispatch(
+            'insert', data, timeout=timeout, priority=priority)
+
+    async def query(self,
+                    query,
+                    time_precision=None,
+                    timeout=60,
+                    priority=PRIORITY_INTERACTIVE):
+        return await self._dispatch(
+            'query',
+            query,
+            time_precision=time_precision,
+            timeout=timeout,
+            priority=priority)
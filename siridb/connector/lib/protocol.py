@@ -3,15 +3,23 @@
 :copyright: 2022, Jeroen van der Heijden (Cesbit.com)
 '''
 import asyncio
+import collections
+import mmap
+import tempfile
+import time
 import qpack
 from . import protomap
 from .datapackage import DataPackage
+from .lazy import LazyResult
 from .exceptions import InsertError
 from .exceptions import QueryError
 from .exceptions import ServerError
 from .exceptions import PoolError
+from .exceptions import PackageError
 from .exceptions import AuthenticationError
 from .exceptions import UserAuthError
+from .constants import PRIORITY_INTERACTIVE
+from .constants import PRIORITY_BULK
 from .logging import logger as logging
 
 
@@ -22,16 +30,54 @@ _MAP = (
 )
 
 
+# bytes which are written per round for each priority when packages are
+# queued, interactive requests get four times the share of bulk requests
+_PRIORITY_QUANTUM = {
+    PRIORITY_INTERACTIVE: 4 * 65536,
+    PRIORITY_BULK: 65536,
+}
+
+# new requests for a priority wait while x bytes are queued, None means that
+# requests are always accepted
+_PRIORITY_QUEUE_LIMIT = {
+    PRIORITY_INTERACTIVE: None,
+    PRIORITY_BULK: 4 * 1024 * 1024,
+}
+
+# after a corrupt header, a header for a larger package is not trusted
+_RESYNC_MAX_LENGTH = 256 * 1024 * 1024
+
+
 def _packdata(tipe, data=None):
     assert tipe in protomap.MAP_REQ_DTYPE, \
         'No data type found for message type: {}'.format(tipe)
     return _MAP[protomap.MAP_REQ_DTYPE[tipe]](data)
 
 
+def encode_insert(data):
+    '''Encode insert data so it can be passed to an insert as-is.
+
+    This function is picklable and can therefore run in a worker process,
+    for example using a concurrent.futures.ProcessPoolExecutor. The result
+    is written to the socket without being encoded again.
+    '''
+    return _packdata(protomap.CPROTO_REQ_INSERT, data)
+
+
 class _SiriDBProtocol(asyncio.Protocol):
 
     _connected = False
 
+    # server metrics, see metrics.Metrics.server()
+    _metrics = None
+
+    # traffic recorder, see capture.Recorder
+    _recorder = None
+    _recorder_id = 0
+
+    # (spill_size, max_size) tuple with limits for the size of a response
+    _response_limits = None
+
     _MAP = {
         # SiriDB Client protocol success response types
         protomap.CPROTO_RES_QUERY: lambda f, d: f.set_result(d),
@@ -75,11 +121,23 @@ class _SiriDBProtocol(asyncio.Protocol):
     def __init__(self, username, password, dbname):
         self._buffered_data = bytearray()
         self._data_package = None
+        # [file or None, remaining bytes] for a payload which is written to
+        # a temporary file, or skipped when the file is None
+        self._large = None
+        # True while data is skipped after a corrupt header
+        self._resyncing = False
         self._pid = 0
         self._requests = {}
+        self._lazy = set()
+        self._metrics_pending = {}
         self._username = username
         self._password = password
         self._dbname = dbname
+        self._paused = False
+        self._drain_waiters = []
+        self._queues = {p: collections.deque() for p in _PRIORITY_QUANTUM}
+        self._queued = dict.fromkeys(_PRIORITY_QUANTUM, 0)
+        self._deficit = dict.fromkeys(_PRIORITY_QUANTUM, 0)
         self.auth_future = None
 
     def connection_made(self, transport):
@@ -90,7 +148,10 @@ class _SiriDBProtocol(asyncio.Protocol):
         self._connected = True
         self.transport = transport
 
-        self.remote_ip, self.port = transport.get_extra_info('peername')[:2]
+        peername = transport.get_extra_info('peername')
+        # the peer name of a unix socket is the path
+        self.remote_ip, self.port = peername[:2] \
+            if isinstance(peername, tuple) else (peername, None)
 
         logging.debug(
             'Connection made (address: {} port: {})'
@@ -123,8 +184,41 @@ class _SiriDBProtocol(asyncio.Protocol):
                 'Connection is lost before we had an answer on package id: {}.'
                 .format(pid)))
 
+        for metrics, _start in self._metrics_pending.values():
+            metrics.on_lost()
+        self._metrics_pending.clear()
+        self._lazy.clear()
+
+        if self._large is not None:
+            if self._large[0] is not None:
+                self._large[0].close()
+            self._large = None
+            self._data_package = None
+
+        self._paused = False
+        for priority, queue in self._queues.items():
+            queue.clear()
+            self._queued[priority] = 0
+        self._wakeup_drain_waiters(ConnectionError(
+            'Connection is lost while waiting for the transport to drain.'))
+
         self.on_connection_lost(exc)
 
+    def pause_writing(self):
+        '''
+        override asyncio.Protocol
+        '''
+        self._paused = True
+
+    def resume_writing(self):
+        '''
+        override asyncio.Protocol
+        '''
+        self._paused = False
+        self._write_queued()
+        if not self._paused:
+            self._wakeup_drain_waiters()
+
     def data_received(self, data):
         '''
         override asyncio.Protocol
@@ -136,24 +230,62 @@ class _SiriDBProtocol(asyncio.Protocol):
                 if size < DataPackage.struct_datapackage.size:
                     return None
                 self._data_package = DataPackage(self._buffered_data)
+                if self._resyncing or not self._data_package.is_valid:
+                    # while resyncing, a header must pass all checks
+                    self._data_package = None
+                    if self._resync():
+                        continue
+                    return None
+                if self._response_limits is not None:
+                    self._check_response_limits()
+            if self._large is not None:
+                if self._large_received():
+                    continue
+                return None
             if size < self._data_package.length:
                 return None
+            if self._recorder is not None:
+                self._recorder.incoming(
+                    self._recorder_id,
+                    self._data_package.pid,
+                    self._buffered_data,
+                    self._data_package.length)
+            if self._metrics is not None:
+                start = time.perf_counter()
             try:
-                self._data_package.extract_data_from(self._buffered_data)
+                # the package is removed from the buffer, even on errors
+                self._data_package.extract_data_from(
+                    self._buffered_data,
+                    lazy=self._data_package.pid in self._lazy)
             except KeyError as e:
                 logging.error('Unsupported package received: {}'.format(e))
+                self._on_package_error(PackageError(
+                    'Unsupported package type received: {}'
+                    .format(self._data_package.tipe)))
             except Exception as e:
                 logging.exception(e)
-                # empty the byte-array to recover from this error
-                self._buffered_data.clear()
+                self._on_package_error(PackageError(
+                    'Failed to decode package: {}'
+                    .format(str(e) or type(e).__name__)))
             else:
+                if self._metrics is not None:
+                    self._on_metrics_received(time.perf_counter() - start)
                 self._on_package_received()
             self._data_package = None
 
-    def send_package(self, tipe, data=None, is_binary=False, timeout=3600):
+    def send_package(self,
+                     tipe,
+                     data=None,
+                     is_binary=False,
+                     timeout=3600,
+                     priority=None,
+                     lazy=False):
         self._pid += 1
         self._pid %= 65536  # pid is handled as uint16_t
 
+        if self._metrics is not None:
+            start = time.perf_counter()
+
         if not is_binary:
             data = _packdata(tipe, data)
 
@@ -163,15 +295,73 @@ class _SiriDBProtocol(asyncio.Protocol):
             tipe,
             tipe ^ 255)
 
-        self.transport.write(header + data)
+        if priority is None or \
+                not self._paused and not any(self._queued.values()):
+            self.transport.write(header + data)
+        else:
+            self._queues[priority].append(header + data)
+            self._queued[priority] += len(header) + len(data)
+
+        if self._recorder is not None:
+            self._recorder.outgoing(
+                self._recorder_id, self._pid, tipe, header, data)
+
+        if self._metrics is not None:
+            metrics = self._metrics.request(tipe)
+            now = time.perf_counter()
+            metrics.on_sent(len(header) + len(data), now - start)
+            self._metrics_pending[self._pid] = (metrics, now)
 
         task = asyncio.ensure_future(self._timeout_request(self._pid,
                                                            timeout,
                                                            tipe))
         future = asyncio.Future()
         self._requests[self._pid] = (future, task)
+        if lazy:
+            self._lazy.add(self._pid)
         return future
 
+    async def drain(self, priority=None):
+        '''Wait until the transport accepts new data.
+
+        The transport pauses the protocol when its write buffer exceeds the
+        high water mark and resumes it when the buffer is drained below the
+        low water mark.
+
+        When a priority is given, packages are queued while the transport is
+        paused, so this only waits while the queue for the priority is full.
+        '''
+        while self._paused if priority is None else (
+                _PRIORITY_QUEUE_LIMIT[priority] is not None and
+                self._queued[priority] >= _PRIORITY_QUEUE_LIMIT[priority]):
+            waiter = asyncio.get_running_loop().create_future()
+            self._drain_waiters.append(waiter)
+            await waiter
+
+    async def send(self,
+                   tipe,
+                   data=None,
+                   is_binary=False,
+                   timeout=3600,
+                   priority=None,
+                   lazy=False):
+        '''Send a package when the transport accepts new data.
+
+        Unlike send_package(), this respects flow control of the transport
+        and waits for the response.
+
+        Packages with a priority (PRIORITY_INTERACTIVE or PRIORITY_BULK) are
+        queued per priority while the transport is paused. When resumed,
+        the queues are written using weighted fair scheduling, so
+        interactive requests do not have to wait for all queued bulk
+        requests.
+
+        When `lazy` is True, a query result is returned as LazyResult.
+        '''
+        await self.drain(priority)
+        return await self.send_package(
+            tipe, data, is_binary, timeout, priority, lazy)
+
     def on_connection_made(self):
         '''
         Called when a connection is made.
@@ -195,15 +385,209 @@ class _SiriDBProtocol(asyncio.Protocol):
         '''
         pass
 
+    def _write_queued(self):
+        '''Write queued packages using deficit round robin scheduling.'''
+        written = False
+        while not self._paused and any(self._queued.values()):
+            for priority, queue in self._queues.items():
+                if not queue:
+                    self._deficit[priority] = 0
+                    continue
+                self._deficit[priority] += _PRIORITY_QUANTUM[priority]
+                while queue and not self._paused and \
+                        len(queue[0]) <= self._deficit[priority]:
+                    package = queue.popleft()
+                    self._deficit[priority] -= len(package)
+                    self._queued[priority] -= len(package)
+                    self.transport.write(package)
+                    written = True
+        if written and self._paused:
+            # room in the queues might be available for waiting requests
+            self._wakeup_drain_waiters()
+
+    def _wakeup_drain_waiters(self, exc=None):
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if exc is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(exc)
+
+    def _on_metrics_received(self, decode_time):
+        try:
+            metrics, start = \
+                self._metrics_pending.pop(self._data_package.pid)
+        except KeyError:
+            return
+        metrics.on_received(
+            time.perf_counter() - start,
+            self._data_package.length,
+            decode_time,
+            self._data_package.tipe >= protomap.CPROTO_ERR_MSG)
+
     async def _timeout_request(self, pid, timeout, tipe):
         await asyncio.sleep(timeout)
+        if pid in self._metrics_pending:
+            self._metrics_pending.pop(pid)[0].on_timeout()
         if not self._requests[pid][0].cancelled():
             self._requests[pid][0].set_exception(TimeoutError(
                 'Request timed out on PID {} ({})'
                 .format(pid, protomap.TEXT_REQ_MAP.get(tipe, 'UNKNOWN'))))
         del self._requests[pid]
+        self._lazy.discard(pid)
+
+    def _is_header(self, offset):
+        length, pid, tipe, checkbit = \
+            DataPackage.struct_datapackage.unpack_from(
+                self._buffered_data, offset)
+        return tipe ^ 255 == checkbit and \
+            tipe in protomap.MAP_RES_DTYPE and \
+            pid in self._requests and \
+            length <= _RESYNC_MAX_LENGTH and (
+                length == 0 or
+                protomap.MAP_RES_DTYPE[tipe] != protomap.DTYPE_NONE)
+
+    def _resync(self):
+        '''Skip data after a corrupt header until the next valid header.
+
+        Returns True when a valid header is found. Otherwise only the last
+        bytes, which might be the start of a header, are kept and False is
+        returned. A header is valid when the type and check bit match, the
+        package id is of a pending request and the length is sane. Until a
+        valid header is found, data is checked from the first byte as well.
+
+        Since the length of the corrupt package cannot be trusted, it is not
+        known which response was lost. Responses usually arrive in order, so
+        requests which are sent before the request of the next valid header
+        are failed. When no valid header is found, the oldest pending
+        request is failed right away, since the corrupt response might be
+        the last one which is expected.
+        '''
+        size = DataPackage.struct_datapackage.size
+        end = len(self._buffered_data) - size + 1
+        for offset in range(0 if self._resyncing else 1, end):
+            if self._is_header(offset):
+                break
+        else:
+            logging.error(
+                'Corrupt package header received, skipped {} bytes'
+                .format(max(0, end)))
+            del self._buffered_data[:max(0, end)]
+            if not self._resyncing and self._requests:
+                # only once for each corrupt header
+                self._resyncing = True
+                oldest = max(
+                    self._requests, key=lambda p: (self._pid - p) % 65536)
+                self._on_package_error(PackageError(
+                    'Response for package id {} is lost due to a corrupt '
+                    'package header'.format(oldest)), oldest)
+            return False
+
+        self._resyncing = False
+
+        if offset:
+            logging.error(
+                'Corrupt package header received, skipped {} bytes'
+                .format(offset))
+            del self._buffered_data[:offset]
+
+        pid = DataPackage.struct_datapackage.unpack_from(
+            self._buffered_data)[1]
+        age = (self._pid - pid) % 65536
+        for lost in [
+                p for p in self._requests
+                if (self._pid - p) % 65536 > age]:
+            self._on_package_error(PackageError(
+                'Response for package id {} is lost due to a corrupt '
+                'package header'.format(lost)), lost)
+        return True
+
+    def _on_package_error(self, exc, pid=None):
+        '''Fail a request for which the response cannot be read.'''
+        if pid is None:
+            pid = self._data_package.pid
+        if pid in self._metrics_pending:
+            self._metrics_pending.pop(pid)[0].on_lost()
+        self._lazy.discard(pid)
+        try:
+            future, task = self._requests.pop(pid)
+        except KeyError:
+            return
+        task.cancel()
+        if not future.cancelled():
+            future.set_exception(exc)
+
+    def _check_response_limits(self):
+        '''Start spilling or skipping the payload of a large response.'''
+        spill_size, max_size = self._response_limits
+        header_size = DataPackage.struct_datapackage.size
+        length = self._data_package.length - header_size
+        pid = self._data_package.pid
+        if max_size is not None and length > max_size:
+            logging.error(
+                'Response for package id {} is too large: {} bytes'
+                .format(pid, length))
+            self._on_package_error(PackageError(
+                'Response for package id {} is too large ({} bytes, limit '
+                '{} bytes)'.format(pid, length, max_size)))
+            fp = None
+        elif spill_size is not None and length > spill_size and \
+                self._data_package.tipe == protomap.CPROTO_RES_QUERY:
+            # an unknown package id is skipped
+            fp = tempfile.TemporaryFile() if pid in self._requests else None
+        else:
+            return
+        # the header is not written; large responses are not recorded
+        del self._buffered_data[:header_size]
+        self._large = [fp, length]
+
+    def _large_received(self):
+        '''Move data from the buffer to the temporary file, or skip data.
+
+        Returns True when the complete payload is received.
+        '''
+        fp, remaining = self._large
+        n = min(remaining, len(self._buffered_data))
+        if fp is not None:
+            with memoryview(self._buffered_data) as view, \
+                    view[:n] as chunk:
+                fp.write(chunk)
+        del self._buffered_data[:n]
+        remaining -= n
+        if remaining:
+            self._large[1] = remaining
+            return False
+
+        self._large = None
+        if fp is not None:
+            if self._metrics is not None:
+                start = time.perf_counter()
+            try:
+                fp.flush()
+                data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    self._data_package.data = LazyResult(data)
+                except Exception:
+                    data.close()
+                    raise
+            except Exception as e:
+                logging.exception(e)
+                self._on_package_error(PackageError(
+                    'Failed to read spilled package: {}'
+                    .format(str(e) or type(e).__name__)))
+            else:
+                if self._metrics is not None:
+                    self._on_metrics_received(time.perf_counter() - start)
+                self._on_package_received()
+            finally:
+                fp.close()
+        self._data_package = None
+        return True
 
     def _on_package_received(self):
+        self._lazy.discard(self._data_package.pid)
         try:
             future, task = self._requests.pop(self._data_package.pid)
         except KeyError:
@@ -251,7 +635,13 @@ class _SiriDBInfoProtocol(_SiriDBProtocol):
 
 class _SiriDBConnProtocol(_SiriDBProtocol):
 
+    # optional function which is called with the protocol when the
+    # connection is lost
+    lost_callback = None
+
     def on_connection_lost(self, exc):
+        if self.lost_callback is not None:
+            self.lost_callback(self)
         if hasattr(self, 'close_future'):
             self.close_future.set_result(None)
             delattr(self, 'close_future')
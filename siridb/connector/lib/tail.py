@@ -0,0 +1,171 @@
+'''Tail queries.
+
+Repeatedly queries series for new points only and keeps the points of a
+recent time window in memory.
+
+:copyright: 2022, Jeroen van der Heijden (Cesbit.com)
+'''
+import array
+import asyncio
+
+
+class _Window:
+
+    __slots__ = ('timestamps', 'values')
+
+    def __init__(self):
+        self.timestamps = array.array('q')
+        self.values = None
+
+    def extend(self, points):
+        for ts, value in points:
+            if self.values is None:
+                self.values = \
+                    array.array('d') if isinstance(value, float) else \
+                    array.array('q') if isinstance(value, int) else []
+            elif isinstance(value, float) and \
+                    isinstance(self.values, array.array) and \
+                    self.values.typecode == 'q':
+                self.values = array.array('d', self.values)
+            self.timestamps.append(ts)
+            self.values.append(value)
+
+    def trim(self, start):
+        '''Remove points with a timestamp equal to or before `start`.'''
+        n = 0
+        for ts in self.timestamps:
+            if ts > start:
+                break
+            n += 1
+        if n:
+            del self.timestamps[:n]
+            del self.values[:n]
+
+    def points(self):
+        return [[ts, value] for ts, value in zip(self.timestamps, self.values)]
+
+
+class Tail:
+    '''Asynchronous iterator which yields new points for series.
+
+    Use SiriDBClient.tail() to create a tail. Every `interval` seconds the
+    series are queried for points after the newest point seen, minus `lag`,
+    and a dictionary with the new points per series is yielded. The points
+    of the last `window` (using the time precision of the database) are
+    kept in memory and can be read using window().
+
+    Series which are behind the newest point are queried in a second query
+    for points after their own last point, minus `lag`, so an idle series
+    does not widen the query for all series. A series without points in
+    the window is no longer queried on its own. Points which are received
+    for a series with a timestamp older than the newest point already seen
+    for that series are ignored. Use `lag` when points may arrive late
+    within a series.
+    '''
+
+    def __init__(self,
+                 client,
+                 series,
+                 interval,
+                 window,
+                 lag=0,
+                 timeout=60):
+        assert interval > 0, 'interval should be a positive number'
+        assert window > 0, 'window should be a positive integer'
+        assert lag >= 0, 'lag should be a positive integer or 0'
+        self._client = client
+        self._series = series
+        self._interval = interval
+        self._window = window
+        self._lag = lag
+        self._timeout = timeout
+        self._windows = {}
+        self._last = {}
+        self._newest = None
+        self._is_first = True
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._is_first:
+            self._is_first = False
+        else:
+            await asyncio.sleep(self._interval)
+        return await self.poll()
+
+    async def poll(self):
+        '''Query for new points, returns the new points per series.'''
+        if self._newest is None:
+            queries = ['select * from {} after now - {}'.format(
+                self._series, self._window)]
+        else:
+            after = self._newest - self._lag
+            queries = ['select * from {} after {}'.format(
+                self._series, after)]
+            lagging = [
+                name for name, last in self._last.items() if last < after]
+            if lagging:
+                # series which are behind are queried on their own so they
+                # do not make the query for all other series wider
+                queries.insert(0, 'select * from {} after {}'.format(
+                    ', '.join(
+                        '"{}"'.format(name.replace('"', '""'))
+                        for name in lagging),
+                    min(self._last[name] for name in lagging) - self._lag))
+
+        results = await asyncio.gather(*(
+            self._client.query(query, timeout=self._timeout)
+            for query in queries))
+
+        batch = {}
+        for name, points in (
+                item for result in results for item in result.items()):
+            last = self._last.get(name)
+            if last is not None:
+                points = [point for point in points if point[0] > last]
+            if not points:
+                continue
+            batch.setdefault(name, []).extend(points)
+            self._last[name] = points[-1][0]
+            window = self._windows.get(name)
+            if window is None:
+                window = self._windows[name] = _Window()
+            window.extend(points)
+            if self._newest is None or points[-1][0] > self._newest:
+                self._newest = points[-1][0]
+
+        if self._newest is not None:
+            start = self._newest - self._window
+            for name, window in list(self._windows.items()):
+                window.trim(start)
+                if not window.timestamps:
+                    del self._windows[name]
+            # series without points in the window are no longer queried on
+            # their own
+            for name, last in list(self._last.items()):
+                if last <= start:
+                    del self._last[name]
+        return batch
+
+    def window(self, name=None):
+        '''Returns the points in the window for a series, or when no name
+        is given, a dictionary with the points for all series.'''
+        if name is not None:
+            window = self._windows.get(name)
+            return [] if window is None else window.points()
+        return {
+            name: window.points()
+            for name, window in self._windows.items()}
+
+    def arrays(self, name):
+        '''Returns a (timestamps, values) tuple for a series.
+
+        Timestamps are an array of integers and values are an array of
+        integers or floats (or a list for string values). The arrays are
+        changed by the next poll so copy them when they must be kept.
+        '''
+        window = self._windows.get(name)
+        if window is None:
+            return array.array('q'), []
+        return window.timestamps, window.values
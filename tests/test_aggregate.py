@@ -0,0 +1,39 @@
+import unittest
+from siridb.connector import InsertAggregator
+
+
+class _Target:
+
+    def __init__(self):
+        self.inserts = []
+
+    async def insert(self, data, timeout=None):
+        self.inserts.append(data)
+        return {'success_msg': 'ok'}
+
+
+class TestInsertAggregator(unittest.IsolatedAsyncioTestCase):
+
+    async def test_aggregate(self):
+        target = _Target()
+        aggregator = InsertAggregator(target, 10, func='sum')
+        await aggregator.insert({'a': [[1, 1], [5, 2], [12, 3]]})
+        await aggregator.flush(complete_only=True)
+        self.assertEqual(target.inserts, [{'a': [[10, 3]]}])
+
+    async def test_late_point_after_flush(self):
+        target = _Target()
+        aggregator = InsertAggregator(target, 10, func='sum')
+        await aggregator.insert({'a': [[5, 3]]})
+        await aggregator.flush()
+        await aggregator.insert({'a': [[7, 5]]})
+        self.assertIsNone(await aggregator.flush())
+        self.assertEqual(aggregator.dropped, 1)
+
+        await aggregator.insert({'a': [[15, 1]]})
+        await aggregator.flush()
+        self.assertEqual(target.inserts, [{'a': [[10, 3]]}, {'a': [[20, 1]]}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from siridb.connector import SiriDBClient
+from siridb.connector.lib.exceptions import InsertError
+from siridb.connector.lib.broker import SiriDBBroker, BrokerClient
+from siridb.connector.lib.fakeserver import FakeSiriDBServer
+
+
+class TestBroker(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'broker.sock')
+        self.server = FakeSiriDBServer()
+        port = await self.server.start()
+        self.siri = SiriDBClient(
+            'iris', 'siri', 'dbtest', [('127.0.0.1', port)], keepalive=False)
+        await self.siri.connect()
+        self.broker = SiriDBBroker(self.siri, self.path, batch_interval=0.01)
+        await self.broker.start()
+        self.clients = [BrokerClient(self.path) for _ in range(3)]
+
+    async def asyncTearDown(self):
+        for client in self.clients:
+            client.close()
+        self.broker.close()
+        await self.broker.wait_closed()
+        self.siri.close()
+        self.server.close()
+        await self.server.wait_closed()
+        self.tmp.cleanup()
+
+    async def test_batch(self):
+        data = [
+            {'a': [[1, 1]], 'b': [[1, 1.5]]},
+            {'a': [[2, 2]]},
+            {'s{}'.format(i): [[1, i]] for i in range(8)},
+        ]
+        await asyncio.gather(*(
+            client.insert(points)
+            for client, points in zip(self.clients, data)))
+        self.assertEqual(self.server.stats['CPROTO_REQ_INSERT'], 1)
+        self.assertEqual(self.server.series['a'], [[1, 1], [2, 2]])
+        self.assertEqual(self.server.series['b'], [[1, 1.5]])
+        self.assertEqual(len(self.server.series), 10)
+
+    async def test_invalid_insert(self):
+        results = await asyncio.gather(
+            self.clients[0].insert({'a': [[1, 1]]}),
+            self.clients[1].insert({'b': 'invalid'}),
+            self.clients[2].insert(b'\x01'),
+            return_exceptions=True)
+        self.assertIsInstance(results[0], dict)
+        self.assertIsInstance(results[1], InsertError)
+        self.assertIsInstance(results[2], ValueError)
+        self.assertEqual(list(self.server.series), ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+from siridb.connector import SiriDBClient
+from siridb.connector.lib import protomap
+from siridb.connector.lib.connection import SiriDBAsyncConnection
+from siridb.connector.lib.exceptions import AuthenticationError
+from siridb.connector.lib.exceptions import InsertError
+from siridb.connector.lib.exceptions import QueryError
+from siridb.connector.lib.exceptions import ServerError
+from siridb.connector.lib.fakeserver import FakeSiriDBServer
+
+
+class TestFakeServer(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = FakeSiriDBServer()
+        self.port = await self.server.start()
+        self.siri = SiriDBClient(
+            'iris', 'siri', 'dbtest', [('127.0.0.1', self.port)],
+            keepalive=False)
+        await self.siri.connect()
+
+    async def asyncTearDown(self):
+        self.siri.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def test_auth(self):
+        self.assertTrue(self.siri.connected)
+        self.assertEqual(self.server.stats['CPROTO_REQ_AUTH'], 1)
+
+        connection = SiriDBAsyncConnection()
+        with self.assertRaises(AuthenticationError):
+            await connection.connect(
+                'iris', 'wrong', 'dbtest', '127.0.0.1', self.port)
+
+    async def test_insert_and_query(self):
+        result = await self.siri.insert({
+            'a': [[2, 2.5], [1, 1.5]],
+            'b': [[1, 1], [3, 3]],
+        })
+        self.assertEqual(
+            result['success_msg'], 'Successfully inserted 4 point(s).')
+        self.assertEqual(
+            await self.siri.query('select * from "a"'),
+            {'a': [[1, 1.5], [2, 2.5]]})
+        self.assertEqual(
+            await self.siri.query('select * from /.*/ after 2'),
+            {'a': [[2, 2.5]], 'b': [[3, 3]]})
+        self.assertEqual(
+            await self.siri.query('select sum(2) from "b"'),
+            {'b': [[2, 1], [4, 3]]})
+        self.assertEqual(
+            await self.siri.query('list series name, length'),
+            {'columns': ['name', 'length'], 'series': [['a', 2], ['b', 2]]})
+        self.assertEqual(
+            await self.siri.query('count series where name == "a"'),
+            {'series': 1})
+
+    async def test_errors(self):
+        with self.assertRaises(QueryError):
+            await self.siri.query('select * from "unknown"')
+        with self.assertRaises(QueryError):
+            await self.siri.query('drop database')
+        with self.assertRaises(InsertError):
+            await self.siri.insert({'a': [[1, 'x', 'y']]})
+        self.assertEqual(self.server.series, {})
+
+        self.server.inject_error(
+            protomap.CPROTO_ERR_SERVER, request=protomap.CPROTO_REQ_QUERY)
+        connection = SiriDBAsyncConnection()
+        await connection.connect(
+            'iris', 'siri', 'dbtest', '127.0.0.1', self.port)
+        try:
+            with self.assertRaises(ServerError):
+                await connection.query('list series')
+        finally:
+            connection.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import asyncio
+import unittest
+from siridb.connector import SiriDBClient
+from siridb.connector import Metrics
+from siridb.connector.lib.connection import SiriDBAsyncConnection
+from siridb.connector.lib.fakeserver import FakeSiriDBServer
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = FakeSiriDBServer()
+        self.port = await self.server.start()
+        self.name = '127.0.0.1:{}'.format(self.port)
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def test_connections_to_one_server(self):
+        metrics = Metrics()
+        siri = SiriDBClient(
+            'iris', 'siri', 'dbtest',
+            [('127.0.0.1', self.port), ('127.0.0.1', self.port)],
+            keepalive=False,
+            metrics=metrics)
+        await siri.connect()
+        siri.close()
+        server = metrics.snapshot()[self.name]
+        self.assertEqual(server['connects'], 2)
+        self.assertEqual(server['reconnects'], 0)
+
+    async def test_reconnect(self):
+        metrics = Metrics()
+        connection = SiriDBAsyncConnection()
+        for _ in range(2):
+            await connection.connect(
+                'iris', 'siri', 'dbtest', '127.0.0.1', self.port,
+                metrics=metrics)
+            connection.close()
+            await asyncio.sleep(0)
+        server = metrics.snapshot()[self.name]
+        self.assertEqual(server['connects'], 2)
+        self.assertEqual(server['reconnects'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import asyncio
+import unittest
+import qpack
+from siridb.connector.lib import protomap
+from siridb.connector.lib.connection import SiriDBAsyncConnection
+from siridb.connector.lib.datapackage import DataPackage
+from siridb.connector.lib.fakeserver import FakeSiriDBServer
+
+
+def _package(pid, tipe, data=b'', length=None):
+    return DataPackage.struct_datapackage.pack(
+        len(data) if length is None else length,
+        pid,
+        tipe,
+        tipe ^ 255) + data
+
+
+class TestResync(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = FakeSiriDBServer()
+        self.port = await self.server.start()
+        self.conn = SiriDBAsyncConnection()
+        await self.conn.connect(
+            'iris', 'siri', 'dbtest', '127.0.0.1', self.port)
+
+    async def asyncTearDown(self):
+        self.conn.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def test_garbage_with_checkbit_while_resyncing(self):
+        protocol = self.conn._protocol
+        self.server.pause()
+        task = asyncio.ensure_future(self.conn.query('select * from "a"'))
+        await asyncio.sleep(0.01)
+        pid = protocol._pid
+
+        # the checkbit matches but the package id is unknown and the length
+        # is not sane, which must not be used as a header while resyncing
+        protocol._resyncing = True
+        protocol.data_received(
+            _package(pid + 100, protomap.CPROTO_RES_QUERY, length=1 << 30))
+        self.assertTrue(protocol._resyncing)
+        self.assertFalse(task.done())
+
+        data = qpack.packb({'a': [[1, 1]]})
+        protocol.data_received(
+            _package(pid, protomap.CPROTO_RES_QUERY, data))
+        self.assertEqual(await asyncio.wait_for(task, 5), {'a': [[1, 1]]})
+        self.assertFalse(protocol._resyncing)
+        self.server.resume()
+
+
+if __name__ == '__main__':
+    unittest.main()
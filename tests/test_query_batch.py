@@ -0,0 +1,55 @@
+import asyncio
+import unittest
+from siridb.connector import SiriDBClient
+from siridb.connector.lib.exceptions import QueryError
+from siridb.connector.lib.fakeserver import FakeSiriDBServer
+
+
+class TestQueryBatch(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = FakeSiriDBServer()
+        self.server.series = {
+            'host-{}.cpu'.format(i): [[ts, ts * i] for ts in range(1, 10)]
+            for i in range(20)}
+        port = await self.server.start()
+        self.siri = SiriDBClient(
+            'iris', 'siri', 'dbtest', [('127.0.0.1', port)],
+            keepalive=False,
+            query_batch_window=0.01)
+        await self.siri.connect()
+
+    async def asyncTearDown(self):
+        self.siri.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def test_last(self):
+        self.server.stats.clear()
+        results = await asyncio.gather(*(
+            self.siri.query('select last() from "host-{}.cpu"'.format(i))
+            for i in range(20)))
+        self.assertEqual(results, [
+            {'host-{}.cpu'.format(i): [[9, 9 * i]]} for i in range(20)])
+        self.assertEqual(self.server.stats['CPROTO_REQ_QUERY'], 1)
+
+    async def test_aggregate_with_range(self):
+        results = await asyncio.gather(*(
+            self.siri.query(
+                'select max(5) from "host-{}.cpu" between 2 and 8'.format(i))
+            for i in range(1, 3)))
+        self.assertEqual(results, [
+            {'host-1.cpu': [[5, 5], [10, 7]]},
+            {'host-2.cpu': [[5, 10], [10, 14]]}])
+
+    async def test_error_falls_back(self):
+        results = await asyncio.gather(
+            self.siri.query('select last() from "host-1.cpu"'),
+            self.siri.query('select last() from "unknown"'),
+            return_exceptions=True)
+        self.assertEqual(results[0], {'host-1.cpu': [[9, 9]]})
+        self.assertIsInstance(results[1], QueryError)
+
+
+if __name__ == '__main__':
+    unittest.main()
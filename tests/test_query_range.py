@@ -0,0 +1,42 @@
+import unittest
+from siridb.connector import SiriDBClient
+from siridb.connector.lib.fakeserver import FakeSiriDBServer
+
+
+class TestQueryRange(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = FakeSiriDBServer()
+        self.server.series = {'a': [[ts, ts * 1.5] for ts in range(1, 200)]}
+        port = await self.server.start()
+        self.siri = SiriDBClient(
+            'iris', 'siri', 'dbtest', [('127.0.0.1', port)], keepalive=False)
+        await self.siri.connect()
+
+    async def asyncTearDown(self):
+        self.siri.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def test_same_as_single_query(self):
+        for select, start, end, interval in (
+                ('*', 0, 150, 7),
+                ('mean(10)', 0, 150, 20),
+                ('mean(10)', 3, 147, 20),
+                ('count(5)', 11, 100, 5)):
+            expected = await self.siri.query(
+                'select {} from "a" between {} and {}'.format(
+                    select, start, end))
+            result = await self.siri.query_range(
+                '"a"', start, end, interval, select=select)
+            self.assertEqual(result, expected, select)
+
+    async def test_rejected_selects(self):
+        for select, interval in (('last()', 10), ('mean(10)', 15)):
+            with self.assertRaises(AssertionError):
+                await self.siri.query_range(
+                    '"a"', 0, 100, interval, select=select)
+
+
+if __name__ == '__main__':
+    unittest.main()
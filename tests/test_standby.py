@@ -0,0 +1,58 @@
+import asyncio
+import unittest
+from siridb.connector import SiriDBConn
+from siridb.connector.lib.fakeserver import FakeSiriDBServer
+
+
+async def _wait_for(predicate, timeout=5.0):
+    for _ in range(int(timeout / 0.01)):
+        if predicate():
+            return
+        await asyncio.sleep(0.01)
+    raise asyncio.TimeoutError
+
+
+class TestStandby(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.primary = FakeSiriDBServer()
+        self.primary_port = await self.primary.start()
+        self.standby = FakeSiriDBServer()
+        self.standby_port = await self.standby.start()
+
+    async def asyncTearDown(self):
+        for server in (self.primary, self.standby):
+            server.close()
+            await server.wait_closed()
+
+    async def test_failover_swaps_servers(self):
+        conn = SiriDBConn(
+            'iris', 'siri', 'dbtest', '127.0.0.1', self.primary_port,
+            standby=True,
+            standby_port=self.standby_port)
+
+        def standby_port():
+            standby = conn._standby
+            if standby is None or not standby._connected:
+                return None
+            return standby.transport.get_extra_info('peername')[1]
+
+        try:
+            await conn.connect()
+            await _wait_for(lambda: standby_port() == self.standby_port)
+
+            self.primary.disconnect()
+            await conn.insert({'a': [[1, 1]]})
+            self.assertIn('a', self.standby.series)
+
+            # the new standby connects to the server which was lost
+            await _wait_for(lambda: standby_port() == self.primary_port)
+            self.assertEqual(
+                conn._protocol.transport.get_extra_info('peername')[1],
+                self.standby_port)
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import time
+import unittest
+from siridb.connector import SiriDBClient
+from siridb.connector.lib.fakeserver import FakeSiriDBServer
+from siridb.connector.lib.tail import Tail
+
+
+class _QueryRecorder:
+
+    def __init__(self, client):
+        self.client = client
+        self.queries = []
+
+    async def query(self, query, timeout=None):
+        self.queries.append(query)
+        return await self.client.query(query, timeout=timeout)
+
+
+class TestTail(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = FakeSiriDBServer()
+        port = await self.server.start()
+        self.siri = SiriDBClient(
+            'iris', 'siri', 'dbtest', [('127.0.0.1', port)], keepalive=False)
+        await self.siri.connect()
+
+    async def asyncTearDown(self):
+        self.siri.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def test_idle_series(self):
+        now = int(time.time())
+        self.server.series = {'a': [[now - 5, 1]], 'idle': [[now - 5, 1]]}
+        client = _QueryRecorder(self.siri)
+        tail = Tail(client, '/.*/', interval=1, window=60)
+        self.assertEqual(len(await tail.poll()), 2)
+
+        self.server.series['a'].append([now + 10, 2])
+        self.assertEqual(await tail.poll(), {'a': [[now + 10, 2]]})
+
+        # the idle series is queried on its own
+        client.queries.clear()
+        self.server.series['a'].append([now + 20, 3])
+        self.assertEqual(await tail.poll(), {'a': [[now + 20, 3]]})
+        self.assertEqual(sorted(client.queries), [
+            'select * from "idle" after {}'.format(now - 5),
+            'select * from /.*/ after {}'.format(now + 10)])
+
+        # without points in the window, the idle series is not queried
+        self.server.series['a'].append([now + 100, 4])
+        await tail.poll()
+        client.queries.clear()
+        self.server.series['a'].append([now + 110, 5])
+        self.assertEqual(await tail.poll(), {'a': [[now + 110, 5]]})
+        self.assertEqual(client.queries, [
+            'select * from /.*/ after {}'.format(now + 100)])
+        self.assertEqual(tail.window('idle'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()